@@ -0,0 +1,264 @@
+"""
+This file contains the ArrayGrid class, a NumPy backed variant of the Grid
+"""
+
+import numpy as np
+from grid import Grid
+from pathfinding import enterable
+
+
+class ArrayGrid(Grid):
+    """
+    Grid which stores stateless tiles (e.g. Empty and Wall) as a structure of arrays:
+    a kind id, a symbol index and a color index per square. Passability is looked up
+    by kind, see ArrayGrid.passable_mask(). Only stateful objects (entities) are kept
+    as Python objects.
+
+    A tile square returns the shared instance of its kind (see Object.shared), which is
+    never placed on the index nor registries. Use Grid.writable() to change a tile square.
+    """
+    # Kind id of squares which hold an entity or nothing at all
+    ENTITY = 0
+
+    def __init__(self, width=10, height=10, flyweight=False, tiles=('Empty', 'Wall')):
+        """
+        :param width: Width of the grid in squares
+        :param height: Height of the grid in squares
+        :param flyweight: Flyweight mode of objects stored as entities, see Grid
+        :param tiles: Names of classes stored as tiles when placed with default attributes
+        """
+        super().__init__(width, height, flyweight)
+        self.tiles = tiles
+
+        # Kind id -> prototype object, kind 0 is reserved for entities
+        self.kinds = [None]
+        self.kind_ids = {}
+        self.symbols = [None]
+        self.colors = [None]
+        # Kind id -> symbol and color index
+        self.kind_symbols = np.zeros(1, dtype=np.uint16)
+        self.kind_colors = np.zeros(1, dtype=np.uint16)
+        # Passability class -> kind id -> passability, see ArrayGrid.passable_mask()
+        self.passable_tables = {}
+
+        # (x, y) -> object of all entities on the grid
+        self.entities = {}
+
+    def allocate(self):
+        # Squares are stored in arrays of kind ids, symbol and color indices
+        self.kind = np.zeros((self.width, self.height), dtype=np.uint16)
+        self.symbol = np.zeros((self.width, self.height), dtype=np.uint16)
+        self.color = np.zeros((self.width, self.height), dtype=np.uint16)
+        return None
+
+    def get(self, coords):
+        x, y = coords
+        kind = self.kind[x, y]
+        if kind == self.ENTITY:
+            return self.entities.get((x, y))
+        return self.kinds[kind]
+
+    def tile_kind(self, obj, kwargs=None):
+        """
+        Returns the kind id under which an object is stored as a tile
+        :param obj: Object or class prototype
+        :param kwargs: Object attributes if obj is a prototype
+        :return: Kind id, None if the object must be stored as an entity
+        """
+        cls = obj if isinstance(obj, type) else type(obj)
+        if cls.__name__ not in self.tiles or (kwargs and isinstance(obj, type)):
+            return None
+        kind = self.kind_ids.get(cls)
+        if kind is None:
+            kind = self._register_kind(cls)
+        if obj is self.kinds[kind] or isinstance(obj, type):
+            return kind
+        return kind if self._state(obj) == self._state(self.kinds[kind]) else None
+
+    @staticmethod
+    def _state(obj):
+        """
+        Returns the attributes which distinguish an object from another of the same class
+        :param obj: The object
+        :return: A dict of attribute: value pairs
+        """
+        return {key: getattr(obj, key) for key in obj.schema if key not in ('id', 'coords', 'interned')}
+
+    def _register_kind(self, cls):
+        """
+        Creates the prototype of a new tile kind
+        :param cls: Class of the tile
+        :return: Kind id
+        """
+        proto = cls.shared()
+        for table, value in ((self.symbols, proto.symbol), (self.colors, proto.color)):
+            if value not in table:
+                table.append(value)
+        self.kinds.append(proto)
+        self.kind_ids[cls] = len(self.kinds) - 1
+        self.kind_symbols = np.append(self.kind_symbols, self.symbols.index(proto.symbol)).astype(np.uint16)
+        self.kind_colors = np.append(self.kind_colors, self.colors.index(proto.color)).astype(np.uint16)
+        self.passable_tables.clear()
+        return len(self.kinds) - 1
+
+    def _write(self, area, kind):
+        """
+        Writes a tile kind into all arrays
+        :param area: Square coordinates or a NumPy index of squares
+        :param kind: Kind id
+        :return: None
+        """
+        self.kind[area] = kind
+        self.symbol[area] = self.kind_symbols[kind]
+        self.color[area] = self.kind_colors[kind]
+
+    def _store(self, crd, obj):
+        crd = tuple(crd)
+        if obj is None:
+            self.entities.pop(crd, None)
+        else:
+            self.entities[crd] = obj
+        self._write(crd, self.ENTITY)
+
+    def place_object_f(self, crd, obj, **kwargs):
+        kind = self.tile_kind(obj, kwargs)
+        if kind is None:
+            super().place_object_f(crd, obj, **kwargs)
+            return
+        self._release(crd)
+        self.entities.pop(tuple(crd), None)
+        self._write(tuple(crd), kind)
+        self.touch(tuple(crd))
+
+    def fill(self, obj, **kwargs):
+        kind = self.tile_kind(obj, kwargs)
+        if kind is None:
+            super().fill(obj, **kwargs)
+            return
+        for crd in list(self.entities):
+            self._release(crd)
+        self.entities.clear()
+        self._write(Ellipsis, kind)
+        self.touch_all()
+
+    def paint_kinds(self, within, index, prototypes):
+        kinds = [self.tile_kind(proto) for proto in prototypes]
+        if None in kinds:
+            super().paint_kinds(within, index, prototypes)
+            return
+        (x1, y1), (x2, y2) = within
+        for crd in [crd for crd in self.entities if x1 <= crd[0] < x2 and y1 <= crd[1] < y2]:
+            self._release(crd)
+            del self.entities[crd]
+
+        self._write_area(within, np.array(kinds, dtype=np.uint16)[np.asarray(index)])
+        self.touch_all()
+
+    def _write_area(self, within, kind):
+        """
+        Writes tile kinds into all arrays
+        :param within: Area ((x1, y1), (x2, y2)) within the grid, x2 and y2 excluded
+        :param kind: Array of kind ids of shape (x2 - x1, y2 - y1)
+        :return: None
+        """
+        (x1, y1), (x2, y2) = within
+        area = np.s_[x1:x2, y1:y2]
+        self.kind[area] = kind
+        self.symbol[area] = self.kind_symbols[kind]
+        self.color[area] = self.kind_colors[kind]
+
+    def passable_mask(self, name=None, keys=(), within=None):
+        # Tiles are looked up by kind, so only the entities are checked one by one
+        (x1, y1), (x2, y2) = within = self._clip(within or ((0, 0), (self.width, self.height)))
+        cls = (name, keys)
+        table = self.passable_tables.get(cls)
+        if table is None:
+            table = self.passable_tables[cls] = np.array([proto is not None and proto.passable_by(name, keys)
+                                                          for proto in self.kinds], dtype=bool)
+        mask = table[self._kinds(within)]
+        for (x, y), obj in self.entities.items():
+            if x1 <= x < x2 and y1 <= y < y2:
+                mask[x - x1, y - y1] = enterable(obj, cls)
+        return mask
+
+    def _kinds(self, within):
+        """
+        Returns the kind ids of the squares of an area
+        :param within: Area ((x1, y1), (x2, y2)) within the grid, x2 and y2 excluded
+        :return: Array of shape (x2 - x1, y2 - y1)
+        """
+        (x1, y1), (x2, y2) = within
+        return self.kind[x1:x2, y1:y2]
+
+    def query(self, within=None, **kwargs):
+        ret = super().query(within, **kwargs)
+        if 'id' in kwargs:
+            return ret
+        # Tile squares are only searched for kinds which match, e.g. not for the player
+        kinds = [kind for kind, proto in enumerate(self.kinds) if proto is not None
+                 and all(getattr(proto, key, None) == value for key, value in kwargs.items())]
+        if kinds:
+            ret.extend(self._find_kinds(self._clip(within or ((0, 0), (self.width, self.height))), kinds))
+            ret.sort()
+        return ret
+
+    def _find_kinds(self, within, kinds):
+        """
+        Returns coordinates of the squares of given tile kinds
+        :param within: Area ((x1, y1), (x2, y2)) within the grid, x2 and y2 excluded
+        :param kinds: List of kind ids
+        :return: A list of (x, y) coordinates
+        """
+        (x1, y1), _ = within
+        xs, ys = np.nonzero(np.isin(self._kinds(within), kinds))
+        return list(zip((xs + x1).tolist(), (ys + y1).tolist()))
+
+    def _hash_squares(self, digest):
+        kinds = self._kinds(((0, 0), (self.width, self.height)))
+        self._hash_layer(digest, [kinds], np.bincount(kinds.ravel(), minlength=len(self.kinds)))
+
+    def _hash_layer(self, digest, strips, counts):
+        """
+        Adds the class names of the objects on all squares to a state digest, in the form
+        of Grid._hash_squares()
+        :param digest: hashlib digest
+        :param strips: Iterable of kind arrays of consecutive columns of the grid, of shape (columns, height)
+        :param counts: Number of squares of each kind id on the grid
+        :return: None
+        """
+        kind_names = [''] + [type(proto).__name__ for proto in self.kinds[1:]]
+        names = {kind_names[kind] for kind in np.nonzero(counts)[0].tolist() if kind != self.ENTITY}
+        names.update(type(obj).__name__ for obj in self.entities.values())
+        if counts[self.ENTITY] > len(self.entities):
+            names.add('')
+        names = sorted(names)
+        index = {name: i for i, name in enumerate(names)}
+        table = np.array([index.get(name, 0) for name in kind_names], dtype=np.uint16)
+        digest.update(repr(names).encode())
+
+        entities = sorted(self.entities.items())
+        n = x = 0
+        for kinds in strips:
+            layer = table[kinds]
+            while n < len(entities) and entities[n][0][0] < x + len(kinds):
+                (ex, ey), obj = entities[n]
+                layer[ex - x, ey] = index[type(obj).__name__]
+                n += 1
+            digest.update(layer.tobytes())
+            x += len(kinds)
+
+    def glyphs(self, within=None):
+        (x1, y1), (x2, y2) = within or ((0, 0), (self.width, self.height))
+        x1, y1 = max(x1, 0), max(y1, 0)
+        area = np.s_[x1:x2, y1:y2]
+        xs, ys = np.nonzero(self.kind[area])
+        for x, y, sym, col in zip((xs + x1).tolist(), (ys + y1).tolist(),
+                                  self.symbol[area][xs, ys].tolist(), self.color[area][xs, ys].tolist()):
+            yield x, y, self.symbols[sym], self.colors[col]
+        xs, ys = np.nonzero(self.kind[area] == self.ENTITY)
+        for x, y in zip((xs + x1).tolist(), (ys + y1).tolist()):
+            obj = self.entities.get((x, y))
+            if obj is None:
+                yield x, y, None, None
+            else:
+                yield x, y, obj.symbol, obj.color
@@ -0,0 +1,346 @@
+"""
+This file contains the benchmark suite of the game. Run this file to time grid
+operations, object ticks and rendering on grids of several sizes, e.g.
+
+    python benchmark.py --sizes 10 100 1000 --output results.json
+    python benchmark.py --compare results.json
+
+The benchmarks run in a headless SDL environment (dummy video driver).
+"""
+
+import os
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import time
+from random import Random
+
+import pygame
+import objects
+import init
+import levels
+from grid import create_grid
+from config import GRID_CONFIG
+from constants import Type
+from pathfinding import passability_class
+
+
+DIRECTIONS = ("up", "right", "down", "left")
+
+
+def use_grid(grid):
+    """
+    Makes a grid the one manipulated by objects and by the Game
+    :param grid: The grid
+    :return: The grid
+    """
+    objects.use_grid(grid)
+    return grid
+
+
+def measure(func, repeat=3, min_time=0.1):
+    """
+    Times a function. The function is called in batches, large enough
+    to take at least min_time seconds each.
+    :param func: Function without arguments
+    :param repeat: Number of timed batches
+    :param min_time: Minimal duration of a batch in seconds
+    :return: A dict with the batch size and the best and mean time of one call in seconds
+    """
+    def batch(number):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        return time.perf_counter() - start
+
+    number = 1
+    elapsed = batch(number)
+    while elapsed < min_time:
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9)))
+        elapsed = batch(number)
+    times = [elapsed] + [batch(number) for _ in range(repeat - 1)]
+    return {
+        'number': number,
+        'best_s': min(times) / number,
+        'mean_s': sum(times) / len(times) / number
+    }
+
+
+def build_scene(size, backend, seed=0):
+    """
+    Creates a grid with random walls, keys, doors and drones, and the player in the middle
+    :param size: Width and height of the grid in squares
+    :param backend: Grid backend, see create_grid
+    :param seed: Random seed of the scene
+    :return: The grid
+    """
+    rng = Random(seed)
+    grid = use_grid(create_grid(backend, size, size, flyweight=GRID_CONFIG.get('flyweight', False)))
+    grid.fill(objects.Empty)
+
+    squares = [(x, y) for x in range(size) for y in range(size)]
+    for crd in rng.sample(squares, len(squares) // 5):
+        grid.place_object_f(crd, objects.Wall)
+    for cls in (objects.SmallKey, objects.KeyDoor, objects.AllyDrone):
+        for crd in rng.sample(squares, max(1, size // 2)):
+            grid.place_object_f(crd, cls)
+
+    center = size // 2
+    for x in range(max(0, center - 1), min(size, center + 2)):
+        for y in range(max(0, center - 1), min(size, center + 2)):
+            grid.place_object_f((x, y), objects.Empty)
+    grid.place_object_f((center, center), objects.Player)
+    return grid
+
+
+def enclose_player(grid):
+    """
+    Surrounds the player with walls, so that drones keep colliding without reaching it
+    :param grid: The grid
+    :return: None
+    """
+    x, y = grid.get_player().get_coords()
+    for crd in grid.get_adjacent((x, y)).values():
+        if 0 <= crd[0] < grid.width and 0 <= crd[1] < grid.height:
+            grid.place_object_f(crd, objects.Wall)
+
+
+def bench_grid(size, backend, run):
+    """
+    Grid queries, object movement and dynamic object ticks
+    :param size: Width and height of the grid in squares
+    :param backend: Grid backend
+    :param run: Function which times and records a benchmark, see main()
+    :return: None
+    """
+    grid = build_scene(size, backend)
+    run('grid.match_name', lambda: grid.match(name="wall"))
+    run('grid.match_type_area', lambda: grid.match(within=((0, 0), (10, 10)), type=Type.DYNAMIC))
+    run('grid.find', lambda: grid.find(name="small_key"))
+    run('grid.get_player', grid.get_player)
+    run('grid.get_dynamic_objects', grid.get_dynamic_objects)
+
+    rng = Random(1)
+    player = grid.get_player()
+
+    def move():
+        # Moves off the grid are not collisions, the player turns back instead
+        direction = rng.choice(DIRECTIONS)
+        x, y = player.get_adjacent()[direction]
+        if 0 <= x < grid.width and 0 <= y < grid.height:
+            player.move(direction)
+    run('object.move', move)
+
+    enclose_player(grid)
+
+    def tick():
+        for obj in grid.get_dynamic_objects():
+            if grid.locate(obj.id) is not None:
+                obj.behavior(pygame.K_RIGHT)
+    run('object.tick', tick)
+
+    # Two targets within a few squares of each other keep their own flow fields
+    grid.distance_maps = None
+    targets = [(size // 2, size // 2), (size // 2 + 1, size // 2 + 2)]
+    chasers = [(max(x - 4, 0), y) for x, y in targets]
+    cls = passability_class(objects.AllyDrone())
+
+    def chase():
+        for crd, target in zip(chasers, targets):
+            grid.distance_map(target, cls).direction(crd)
+    run('path.two_targets', chase)
+    computed = sum(field.computed for field in grid.distance_maps.fields.values())
+    if computed != len(targets):
+        raise RuntimeError(f"Flow fields of {len(targets)} targets were computed {computed} times")
+
+    maze = objects.MazeGenerator(working_area=((0, 0), (size, size)), path_str=((0, 0), "r" * (size - 1)))
+    run('maze.draw_maze', maze.draw_maze)
+
+
+def bench_levels(game, run):
+    """
+    Loading of all levels of the game, by the level methods and from the compiled files
+    :param game: The Game
+    :param run: Function which times and records a benchmark
+    :return: None
+    """
+    grid = use_grid(create_grid(**GRID_CONFIG))
+
+    def load(level):
+        level()
+        # Events posted by the level are not handled here
+        grid.take_events()
+
+    for name in sorted(key for key in vars(init.Game) if key.startswith('level')):
+        run('game.' + name, lambda: load(getattr(game, name)), size=GRID_CONFIG['width'])
+        level = int(name[len('level'):])
+        if levels.load_level(game, level):
+            grid.take_events()
+            run('levels.' + name, lambda: load(lambda: levels.load_level(game, level)), size=GRID_CONFIG['width'])
+
+
+def bench_draw(game, size, backend, run):
+    """
+    Rendering of the grid
+    :param game: The Game
+    :param size: Width and height of the grid in squares
+    :param backend: Grid backend
+    :param run: Function which times and records a benchmark
+    :return: None
+    """
+    grid = build_scene(size, backend)
+    rng = Random(2)
+    visible = min(size, game.game_surf.get_width() // grid.field_width)
+
+    def draw_full():
+        grid.redraw_all = True
+        game.draw()
+        game.updated_rects = []
+
+    def draw_dirty():
+        for _ in range(10):
+            grid.dirty.add((rng.randrange(visible), rng.randrange(visible)))
+        game.draw()
+        game.updated_rects = []
+
+    run('game.draw_full', draw_full)
+    run('game.draw_dirty10', draw_dirty)
+
+
+def bench_console(game, run):
+    """
+    Writing to the console output and rendering the console. Writes and rendered lines
+    are cached until the next frame, so every case renders what it changed.
+    :param game: The Game
+    :param run: Function which times and records a benchmark
+    :return: None
+    """
+    console = game.console
+    output = console.console_output
+    surface = pygame.Surface(console.get_size())
+
+    def write():
+        # The output follows the written lines, as after a command
+        output.write("name = 'player'\ncolor = (255, 255, 255)")
+        output.buffer_offset = max(0, len(output.buffer) - output.display_lines)
+        output.refresh()
+
+    def invalidate():
+        output.line_surfaces.clear()
+        output.txt_rows = [None] * output.display_lines
+
+    def prepare():
+        invalidate()
+        output.prepare_surface()
+
+    def render():
+        invalidate()
+        output.changed = True
+        console.show(surface)
+
+    run('console.write', write, size=0)
+    run('console.prepare_surface', prepare, size=0)
+    enabled, console.enabled, console.anim_perc = console.enabled, True, 100
+    run('console.render', render, size=0)
+    console.enabled = enabled
+
+
+def git_commit():
+    """
+    Returns the current commit of the repository
+    :return: Short commit hash, None if unavailable
+    """
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                             text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints benchmarks which got slower than in a baseline run
+    :param results: Results of this run
+    :param baseline: Results loaded from a JSON file
+    :param threshold: Slowdown ratio reported as a regression
+    :return: Number of regressions
+    """
+    old = {(r['name'], r['size'], r['backend']): r for r in baseline['results']}
+    regressions = 0
+    for r in results:
+        prev = old.get((r['name'], r['size'], r['backend']))
+        if prev is None:
+            continue
+        ratio = r['best_s'] / prev['best_s'] if prev['best_s'] else float('inf')
+        flag = ''
+        if ratio > threshold:
+            regressions += 1
+            flag = '  REGRESSION'
+        print(f"{r['name']:28} {r['size']:>5} {r['backend']:6} {ratio:7.2f}x{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times grid operations, object ticks and rendering")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000],
+                        help="Widths (and heights) of the benchmarked grids")
+    parser.add_argument('--backend', default=GRID_CONFIG.get('backend', 'list'), choices=('list', 'array', 'chunked'))
+    parser.add_argument('--repeat', type=int, default=3, help="Number of timed batches per benchmark")
+    parser.add_argument('--min-time', type=float, default=0.1, help="Minimal duration of a batch in seconds")
+    parser.add_argument('--output', help="JSON file to save the results to")
+    parser.add_argument('--compare', help="JSON file with baseline results")
+    parser.add_argument('--threshold', type=float, default=1.25, help="Slowdown ratio reported as a regression")
+    args = parser.parse_args()
+
+    results = []
+    current = {'size': 0}
+
+    def run(name, func, size=None):
+        size = current['size'] if size is None else size
+        # Objects print messages, e.g. when the inventory is full
+        with contextlib.redirect_stdout(io.StringIO()):
+            timing = measure(func, args.repeat, args.min_time)
+        result = {'name': name, 'size': size, 'backend': args.backend, **timing}
+        results.append(result)
+        print(f"{name:28} {size:>5} {args.backend:6} {result['best_s'] * 1e6:12.1f} us")
+
+    game = init.Game(1)
+    bench_levels(game, run)
+    bench_console(game, run)
+    for size in args.sizes:
+        current['size'] = size
+        bench_grid(size, args.backend, run)
+        bench_draw(game, size, args.backend, run)
+    pygame.quit()
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'pygame': pygame.version.ver,
+            'sizes': args.sizes,
+            'backend': args.backend
+        },
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if compare(results, baseline, args.threshold):
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,385 @@
+"""
+This file contains the ChunkedGrid class, a variant of the ArrayGrid whose tiles
+are stored in a memory-mapped world file, for worlds larger than the memory.
+
+The world file holds the kind ids of all squares as uint16 chunks of
+chunk_size x chunk_size squares, chunk (i, j) being stored contiguously.
+A JSON file next to it (path + '.json') holds the grid parameters, the names
+of the tile kinds and the entity table, and path + '.counts.npy' holds the number
+of squares of each kind per chunk, see ChunkedGrid.save().
+"""
+
+import json
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+from array_grid import ArrayGrid
+
+
+class ChunkedGrid(ArrayGrid):
+    """
+    ArrayGrid which keeps only recently used chunks of the kind array in memory.
+    Chunks are paged in from the world file when their squares are read or written,
+    or ahead of time by Grid.prefetch(), and the least recently used ones are written
+    back when more than max_chunks are resident.
+
+    Scans of the whole world (queries, glyphs() and state_hash() without an area) skip
+    chunks which hold none of the wanted kinds, and read the others from the file without
+    paging them in. Whole-world passable_mask() is refused, see ChunkedGrid.passable_mask().
+
+    Entities are few and stateful, so they are kept in memory and saved with the meta file.
+    """
+    def __init__(self, width=10, height=10, flyweight=False, tiles=('Empty', 'Wall'),
+                 path=None, chunk_size=64, max_chunks=256, mode='w+'):
+        """
+        :param width: Width of the grid in squares
+        :param height: Height of the grid in squares
+        :param flyweight: Flyweight mode of objects stored as entities, see Grid
+        :param tiles: Names of classes stored as tiles when placed with default attributes
+        :param path: Path of the world file, a temporary file is used by default
+        :param chunk_size: Width and height of a chunk in squares
+        :param max_chunks: Maximal number of chunks kept in memory
+        :param mode: 'w+' to create a new world file, 'r+' to open an existing one (see ChunkedGrid.load)
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+        self.mode = mode
+        super().__init__(width, height, flyweight, tiles)
+
+    def allocate(self):
+        # Squares are stored in the world file, see ChunkedGrid._chunk()
+        size = self.chunk_size
+        self.columns = -(-self.width // size)
+        self.rows = -(-self.height // size)
+        self.file = tempfile.TemporaryFile() if self.path is None else None
+        self.chunks = np.memmap(self.file if self.path is None else self.path, dtype=np.uint16,
+                                mode=self.mode, shape=(self.columns, self.rows, size, size))
+        if self.file is None:
+            # Scans read and write the file directly, see ChunkedGrid._peek()
+            self.file = open(self.path, 'r+b')
+        # Number of squares of each chunk within the grid, chunks at the edges are partly outside
+        self.chunk_squares = np.outer(np.minimum(size, self.width - np.arange(self.columns) * size),
+                                      np.minimum(size, self.height - np.arange(self.rows) * size))
+        # (i, j, kind id) -> number of squares of the kind within the chunk
+        self.counts = np.zeros((self.columns, self.rows, 1), dtype=np.int64)
+        self.counts[..., self.ENTITY] = self.chunk_squares
+        # (i, j) -> kind array of resident chunks, least recently used first
+        self.resident = OrderedDict()
+        # (i, j) index and kind array of the most recently used chunk, which needs no reordering
+        self.recent = (None, None)
+        # Resident chunks changed since they were paged in
+        self.modified = set()
+        self.loads = 0
+        self.evictions = 0
+        return None
+
+    @classmethod
+    def load(cls, path, max_chunks=256):
+        """
+        Opens a world saved by ChunkedGrid.save(). Entities are restored on the new grid.
+        :param path: Path of the world file
+        :param max_chunks: Maximal number of chunks kept in memory
+        :return: The grid
+        """
+        # Imported here, as objects creates the global grid when imported
+        import objects
+        import levels
+
+        with open(path + '.json') as file:
+            meta = json.load(file)
+        grid = cls(meta['width'], meta['height'], meta['flyweight'], tuple(meta['tiles']),
+                   path=path, chunk_size=meta['chunk_size'], max_chunks=max_chunks, mode='r+')
+        for name in meta['kinds']:
+            grid._register_kind(getattr(objects, name))
+        try:
+            counts = np.load(path + '.counts.npy')
+        except OSError:
+            counts = None
+        if counts is not None and counts.shape == grid.counts.shape:
+            grid.counts = counts
+        else:
+            grid._count()
+        previous = objects.use_grid(grid)
+        try:
+            for x, y, value in meta['entities']:
+                grid.place_object_f((x, y), levels.decode(value))
+        finally:
+            objects.use_grid(previous)
+        grid.touch_all()
+        return grid
+
+    def _register_kind(self, cls):
+        kind = super()._register_kind(cls)
+        self.counts = np.concatenate((self.counts, np.zeros((self.columns, self.rows, 1), dtype=np.int64)), axis=2)
+        return kind
+
+    def _count(self):
+        """
+        Counts the squares of each kind in all chunks, reading the world file column by column
+        :return: None
+        """
+        kinds = len(self.kinds)
+        size = self.chunk_size
+        for i, column in enumerate(self._columns()):
+            for j in range(self.rows):
+                part = column[:, j * size:(j + 1) * size]
+                self.counts[i, j] = np.bincount(part.ravel(), minlength=kinds)
+
+    def _offset(self, key):
+        """
+        :param key: (i, j) index of a chunk
+        :return: Position of the chunk in the world file in bytes
+        """
+        return (key[0] * self.rows + key[1]) * self.chunk_size ** 2 * 2
+
+    def _peek(self, key):
+        """
+        Returns a chunk of the kind array without paging it in. A chunk which isn't resident
+        is read from the world file, so that scans don't fill the memory with mapped chunks.
+        :param key: (i, j) index of the chunk
+        :return: Array of shape (chunk_size, chunk_size), not to be written
+        """
+        chunk = self.resident.get(key)
+        if chunk is not None:
+            return chunk
+        size = self.chunk_size
+        data = os.pread(self.file.fileno(), size * size * 2, self._offset(key))
+        return np.frombuffer(data, dtype=np.uint16).reshape(size, size)
+
+    def _columns(self):
+        """
+        Reads the kind array column of chunks by column of chunks, without paging chunks in
+        :return: Iterable of arrays of shape (chunk width, height), the last one cut at the grid edge
+        """
+        size = self.chunk_size
+        for i in range(self.columns):
+            data = os.pread(self.file.fileno(), self.rows * size * size * 2, self._offset((i, 0)))
+            column = np.frombuffer(data, dtype=np.uint16).reshape(self.rows, size, size).copy()
+            for j in range(self.rows):
+                chunk = self.resident.get((i, j))
+                if chunk is not None:
+                    column[j] = chunk
+            yield column.transpose(1, 0, 2).reshape(size, self.rows * size)[:self.width - i * size, :self.height]
+
+    def _chunk(self, key):
+        """
+        Returns a chunk of the kind array, paging it in if it is not resident
+        :param key: (i, j) index of the chunk
+        :return: Array of shape (chunk_size, chunk_size)
+        """
+        if key == self.recent[0]:
+            return self.recent[1]
+        chunk = self.resident.get(key)
+        if chunk is not None:
+            self.resident.move_to_end(key)
+        else:
+            chunk = self.resident[key] = np.array(self.chunks[key])
+            self.loads += 1
+            if len(self.resident) > self.max_chunks:
+                old, data = self.resident.popitem(last=False)
+                if old in self.modified:
+                    self.chunks[old] = data
+                    self.modified.discard(old)
+                self.evictions += 1
+        self.recent = (key, chunk)
+        return chunk
+
+    def _spans(self, within):
+        """
+        Splits an area into its parts lying in separate chunks
+        :param within: Area ((x1, y1), (x2, y2)) within the grid, x2 and y2 excluded
+        :return: Iterable of (key, area, local) tuples: index of the chunk, NumPy index
+        of the part within the area and NumPy index of the part within the chunk
+        """
+        (x1, y1), (x2, y2) = within
+        size = self.chunk_size
+        if x2 <= x1 or y2 <= y1:
+            return
+        for i in range(x1 // size, (x2 - 1) // size + 1):
+            cx1, cx2 = max(x1, i * size), min(x2, (i + 1) * size)
+            for j in range(y1 // size, (y2 - 1) // size + 1):
+                cy1, cy2 = max(y1, j * size), min(y2, (j + 1) * size)
+                yield ((i, j), np.s_[cx1 - x1:cx2 - x1, cy1 - y1:cy2 - y1],
+                       np.s_[cx1 - i * size:cx2 - i * size, cy1 - j * size:cy2 - j * size])
+
+    def _square(self, coords):
+        """
+        Locates a square within its chunk
+        :param coords: (x, y) coordinates of the square
+        :return: A (key, x, y) tuple: index of the chunk and coordinates within the chunk
+        :raises IndexError: If the square is outside the grid
+        """
+        x, y = coords
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise IndexError(f"Square {tuple(coords)} is outside the grid")
+        size = self.chunk_size
+        return (x // size, y // size), x % size, y % size
+
+    def get(self, coords):
+        key, x, y = self._square(coords)
+        kind = self._chunk(key)[x, y]
+        if kind == self.ENTITY:
+            return self.entities.get((coords[0], coords[1]))
+        return self.kinds[kind]
+
+    def _write(self, area, kind):
+        if area is Ellipsis:
+            self.resident.clear()
+            self.recent = (None, None)
+            self.modified.clear()
+            # Written column of chunks by column of chunks without mapping the world file
+            size = self.chunk_size
+            column = np.full((self.rows, size, size), kind, dtype=np.uint16).tobytes()
+            for i in range(self.columns):
+                os.pwrite(self.file.fileno(), column, self._offset((i, 0)))
+            self.counts[...] = 0
+            self.counts[..., kind] = self.chunk_squares
+            return
+        key, x, y = self._square(area)
+        chunk = self._chunk(key)
+        self.counts[key + (chunk[x, y],)] -= 1
+        self.counts[key + (kind,)] += 1
+        chunk[x, y] = kind
+        self.modified.add(key)
+
+    def _write_area(self, within, kind):
+        size = self.chunk_size
+        kinds = len(self.kinds)
+        for key, area, local in self._spans(within):
+            part = kind[area]
+            counts = np.bincount(part.ravel(), minlength=kinds)
+            if part.shape == (size, size) and key not in self.resident:
+                # Chunks which are overwritten entirely are streamed into the file without paging them in
+                os.pwrite(self.file.fileno(), np.ascontiguousarray(part, dtype=np.uint16).tobytes(),
+                          self._offset(key))
+                self.counts[key] = counts
+            else:
+                chunk = self._chunk(key)
+                self.counts[key] += counts - np.bincount(chunk[local].ravel(), minlength=kinds)
+                chunk[local] = part
+                self.modified.add(key)
+
+    def _kinds(self, within):
+        (x1, y1), (x2, y2) = within = self._clip(within)
+        ret = np.zeros((max(x2 - x1, 0), max(y2 - y1, 0)), dtype=np.uint16)
+        for key, area, local in self._spans(within):
+            ret[area] = self._chunk(key)[local]
+        return ret
+
+    def _find_kinds(self, within, kinds):
+        (x1, y1), _ = within
+        ret = []
+        for key, area, local in self._spans(within):
+            if not self.counts[key][kinds].any():
+                continue
+            xs, ys = np.nonzero(np.isin(self._peek(key)[local], kinds))
+            x, y = x1 + area[0].start, y1 + area[1].start
+            ret.extend(zip((xs + x).tolist(), (ys + y).tolist()))
+        return ret
+
+    def passable_mask(self, name=None, keys=(), within=None):
+        """
+        As Grid.passable_mask(), but needs an area: the mask of the whole world may not fit into memory
+        :raises ValueError: If no area is given
+        """
+        if within is None:
+            raise ValueError("ChunkedGrid.passable_mask() needs an area")
+        return super().passable_mask(name, keys, within)
+
+    def _hash_squares(self, digest):
+        self._hash_layer(digest, self._columns(), self.counts.sum(axis=(0, 1)))
+
+    def glyphs(self, within=None):
+        # The whole world is scanned chunk by chunk without paging the chunks in
+        read = self._peek if within is None else self._chunk
+        for key, area, local in self._spans(self._clip(within or ((0, 0), (self.width, self.height)))):
+            kinds = read(key)[local]
+            x1, y1 = key[0] * self.chunk_size + local[0].start, key[1] * self.chunk_size + local[1].start
+            xs, ys = np.nonzero(kinds)
+            for x, y, kind in zip((xs + x1).tolist(), (ys + y1).tolist(), kinds[xs, ys].tolist()):
+                proto = self.kinds[kind]
+                yield x, y, proto.symbol, proto.color
+            xs, ys = np.nonzero(kinds == self.ENTITY)
+            for x, y in zip((xs + x1).tolist(), (ys + y1).tolist()):
+                obj = self.entities.get((x, y))
+                if obj is None:
+                    yield x, y, None, None
+                else:
+                    yield x, y, obj.symbol, obj.color
+
+    def prefetch(self, within):
+        """
+        Pages in the chunks of an area, and the chunks within one chunk of the player
+        and of dynamic objects, so that they are resident before the objects move into them.
+        The prefetched chunks should fit into max_chunks.
+        :param within: Area of the grid ((x1, y1), (x2, y2)), x2 and y2 excluded
+        :return: None
+        """
+        areas = [within]
+        margin = self.chunk_size
+        player = self.get_player()
+        for obj in self.get_dynamic_objects() + ([player] if player is not None else []):
+            crd = self.locate(obj.id)
+            if crd is not None:
+                areas.append(((crd[0] - margin, crd[1] - margin), (crd[0] + margin + 1, crd[1] + margin + 1)))
+        for area in areas:
+            for key, _, _ in self._spans(self._clip(area)):
+                self._chunk(key)
+
+    def save(self, limit=None):
+        """
+        Writes modified chunks back into the world file. With a limit, a save can be
+        spread over many frames while the game keeps running (a streaming save).
+        When no modified chunks are left, the file is flushed and the meta file is written.
+        :param limit: Maximal number of chunks written by this call, all by default
+        :return: Number of modified chunks left to write
+        """
+        for key in sorted(self.modified)[:limit]:
+            self.chunks[key] = self.resident[key]
+            self.modified.discard(key)
+        if self.modified:
+            return len(self.modified)
+        self.chunks.flush()
+        if self.path is not None:
+            self._save_meta()
+        return 0
+
+    def _save_meta(self):
+        """
+        Writes the grid parameters, tile kinds and entities next to the world file
+        :return: None
+        """
+        import levels
+
+        # Entities are saved in order of placement, which decides the order of object behaviors
+        order = {crd: n for n, crd in enumerate(self.positions.values())}
+        entities = sorted(self.entities.items(), key=lambda item: order.get(item[0], len(order)))
+        meta = {
+            'width': self.width,
+            'height': self.height,
+            'chunk_size': self.chunk_size,
+            'flyweight': self.flyweight,
+            'tiles': list(self.tiles),
+            'kinds': [type(proto).__name__ for proto in self.kinds[1:]],
+            'entities': [[x, y, levels.encode(obj)] for (x, y), obj in entities]
+        }
+        with open(self.path + '.json.tmp', 'w') as file:
+            json.dump(meta, file)
+        with open(self.path + '.counts.tmp', 'wb') as file:
+            np.save(file, self.counts)
+        os.replace(self.path + '.counts.tmp', self.path + '.counts.npy')
+        os.replace(self.path + '.json.tmp', self.path + '.json')
+
+    def close(self):
+        """
+        Saves the world and closes the world file. The grid can't be used afterwards.
+        :return: None
+        """
+        self.save()
+        self.resident.clear()
+        self.recent = (None, None)
+        del self.chunks
+        self.file.close()
@@ -1,3 +1,10 @@
+GRID_CONFIG = {
+    'backend': 'list',
+    'width': 30,
+    'height': 30,
+    'flyweight': True
+}
+
 CONSOLE_CONFIG = {
     "global": {
         'animation': ['BOTTOM'],
@@ -0,0 +1,73 @@
+"""
+This file contains the GlyphCache class
+"""
+
+import pygame
+from constants import Colors
+
+
+class GlyphCache:
+    """
+    Stores rendered symbol surfaces, so that each (symbol, color)
+    pair is rendered by the font only once
+    """
+    def __init__(self, font, antialias=True):
+        """
+        :param font: PyGame font used to render the symbols
+        :param antialias: Font antialiasing
+        """
+        self.font = font
+        self.antialias = antialias
+        self.surfaces = {}
+        self.atlas = None
+
+    @staticmethod
+    def key(symbol, color):
+        """
+        Returns the cache key of a glyph
+        :param symbol: Rendered text
+        :param color: RGB color, hacked colors may be lists
+        :return: A hashable (symbol, color) tuple
+        """
+        return symbol, color if isinstance(color, tuple) else tuple(color)
+
+    def get(self, symbol, color):
+        """
+        Returns the surface of a symbol rendered in a given color
+        :param symbol: Rendered text
+        :param color: RGB color
+        :return: Surface with the rendered symbol
+        """
+        key = self.key(symbol, color)
+        surf = self.surfaces.get(key)
+        if surf is None:
+            surf = self.font.render(symbol, self.antialias, color)
+            self.surfaces[key] = surf
+        return surf
+
+    def build_atlas(self, symbols, palette=None):
+        """
+        Renders all symbols in all palette colors onto a single atlas surface.
+        The cache then returns subsurfaces of the atlas for those glyphs.
+        :param symbols: Iterable of symbols
+        :param palette: Iterable of RGB colors, all Colors by default
+        :return: The atlas surface
+        """
+        if palette is None:
+            palette = [val for key, val in vars(Colors).items() if not key.startswith('_')]
+        keys = list(dict.fromkeys(self.key(sym, col) for col in palette for sym in symbols))
+        rendered = [self.font.render(sym, self.antialias, col) for sym, col in keys]
+        if not rendered:
+            return None
+
+        width = max(surf.get_width() for surf in rendered)
+        height = max(surf.get_height() for surf in rendered)
+        columns = max(1, int(len(rendered) ** 0.5))
+        rows = -(-len(rendered) // columns)
+        self.atlas = pygame.Surface((columns * width, rows * height), pygame.SRCALPHA)
+
+        for i, (key, surf) in enumerate(zip(keys, rendered)):
+            rect = surf.get_rect(topleft=((i % columns) * width, (i // columns) * height))
+            self.atlas.blit(surf, rect)
+            self.surfaces[key] = self.atlas.subsurface(rect)
+        return self.atlas
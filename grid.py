@@ -2,7 +2,11 @@
 This file contains the Grid class
 """
 
+import hashlib
+from random import Random
+import numpy as np
 from constants import Type
+from pathfinding import DistanceCache, enterable
 
 
 class Grid:
@@ -10,24 +14,63 @@ class Grid:
     This class resembles the game grid and stores objects on its squares.
     Also contains methods which manipulate those objects
     """
-    def __init__(self, width=10, height=10):
+    # Object attributes by which the objects on the grid are registered
+    REGISTRY_KEYS = ('type', 'name', 'color', 'replacable')
+    # Object attributes which change what is displayed on the square of the object
+    DISPLAY_KEYS = ('symbol', 'color')
+    # Object attributes which change which objects can enter the square of the object,
+    # colors of doors must match colors of keys
+    PASSABILITY_KEYS = ('passable_for', 'stacked', 'color')
+    # Object attributes whose changes are reported to the grid (see Grid.changed)
+    WATCHED_KEYS = frozenset(REGISTRY_KEYS + DISPLAY_KEYS + PASSABILITY_KEYS)
+
+    def __init__(self, width=10, height=10, flyweight=False):
         """
         :param width: Width of the grid in squares
         :param height: Height of the grid in squares
+        :param flyweight: If True, class prototypes flagged as flyweight are placed
+        as one instance shared by all their squares
         """
         self.field_width = 30
         self.field_height = 30
         self.width = width
         self.height = height
+        self.flyweight = flyweight
 
         self.margin_left = int(self.field_width / 2 + 5)
         self.margin_top = int(self.field_height/2 + 5)
 
-        self.grid = [[None] * self.height for _ in range(self.width)]
+        self.grid = self.allocate()
         self.id_counter = 0
+        # Index of object id -> (x, y) coordinates of all objects on the grid
+        self.positions = {}
+        # Index of shared object id -> set of (x, y) coordinates of its squares
+        self.shared_positions = {}
+        # Registries of attribute -> value -> {object id: object}
+        self.registries = {key: {} for key in self.REGISTRY_KEYS}
+        # Squares changed since the last redraw, all of them if redraw_all is set
+        self.dirty = set()
+        self.redraw_all = True
+        # Sets of squares changed since their owners last read them, see Grid.watch()
+        self.watchers = []
+        # Flow fields of chasing objects, created on first use, see Grid.distance_map()
+        self.distance_maps = None
+        # Events posted by objects, handled by the Game on its next step
+        self.events = []
+        # Profiler of the Game running on the grid, read by the console stats command
+        self.profiler = None
+        # Source of randomness of objects on the grid, see Grid.seed()
+        self.rng = Random()
 
         self.level = "level1"
 
+    def allocate(self):
+        """
+        Creates the storage of the grid squares
+        :return: A list of columns of squares
+        """
+        return [[None] * self.height for _ in range(self.width)]
+
     def get(self, coords):
         """
         Returns the object placed on given coordinates of grid
@@ -37,6 +80,240 @@ class Grid:
         """
         return self.grid[coords[0]][coords[1]]
 
+    def locate(self, obj_id):
+        """
+        Returns coordinates of the object with a given id
+        :param obj_id: Id of the object
+        :return: (x, y) coordinates of the object, None if it is not on the grid
+        """
+        return self.positions.get(obj_id)
+
+    def registered(self, key, value):
+        """
+        Returns a snapshot of all objects on the grid registered under a given
+        attribute value. The snapshot is not affected by later changes on the grid.
+        :param key: Registry attribute, one of Grid.REGISTRY_KEYS
+        :param value: Attribute value
+        :return: A list of objects
+        """
+        return list(self.registries[key].get(self._freeze(value), {}).values())
+
+    def changed(self, obj, key, value):
+        """
+        Called before a watched attribute (Grid.WATCHED_KEYS) of an object changes.
+        Moves the object between registries and marks its square for redraw.
+        Objects which are not on the grid are ignored.
+        :param obj: The changed object
+        :param key: Name of the changed attribute
+        :param value: New value of the attribute
+        :return: None
+        """
+        crd = self.positions.get(getattr(obj, 'id', None))
+        if crd is None or self.get(crd) is not obj:
+            return
+        if key in self.registries:
+            self._unregister(key, obj)
+            self.registries[key].setdefault(self._freeze(value), {})[obj.id] = obj
+        if key in self.DISPLAY_KEYS:
+            self.dirty.add(crd)
+        if key in self.PASSABILITY_KEYS:
+            for changes in self.watchers:
+                changes.add(crd)
+
+    def take_dirty(self):
+        """
+        Returns the squares which changed since the last call, and resets them
+        :return: A (redraw_all, squares) tuple, where squares is a set of (x, y)
+        coordinates. If redraw_all is True, every square must be redrawn.
+        """
+        ret = self.redraw_all, self.dirty
+        self.redraw_all, self.dirty = False, set()
+        return ret
+
+    def watch(self):
+        """
+        Returns a set, into which the grid adds coordinates of every square whose object
+        is replaced or changes its passability. None is added when the whole grid changes.
+        The owner of the set reads and clears it.
+        :return: A set of (x, y) coordinates
+        """
+        changes = set()
+        self.watchers.append(changes)
+        return changes
+
+    def touch(self, crd):
+        """
+        Marks a square whose object was replaced, for redraw and for the watchers
+        :param crd: (x, y) coordinates of the square
+        :return: None
+        """
+        self.dirty.add(crd)
+        for changes in self.watchers:
+            changes.add(crd)
+
+    def touch_all(self):
+        """
+        Marks all squares of the grid, for redraw and for the watchers
+        :return: None
+        """
+        self.dirty.clear()
+        self.redraw_all = True
+        for changes in self.watchers:
+            changes.add(None)
+
+    def post(self, event):
+        """
+        Queues an event for the Game. Unlike pygame.event.post, this works without
+        an initialized display.
+        :param event: A PyGame event
+        :return: None
+        """
+        self.events.append(event)
+
+    def take_events(self):
+        """
+        Returns the events posted since the last call, and clears the queue
+        :return: A list of PyGame events
+        """
+        ret, self.events = self.events, []
+        return ret
+
+    def instantiate(self, cls, **kwargs):
+        """
+        Creates an object to be placed on the grid. In flyweight mode, default
+        objects of flyweight classes are the instance shared by all their squares.
+        :param cls: Class of the object
+        :param kwargs: Object attributes
+        :return: The object
+        """
+        if self.flyweight and not kwargs and cls.flyweight:
+            return cls.shared()
+        return cls(**kwargs)
+
+    def writable(self, crd):
+        """
+        Returns the object on a given square, which can be safely changed.
+        A shared object is first replaced by its own copy on that square.
+        :param crd: Coordinates of the square
+        :return: The object on the square
+        """
+        obj = self.get(crd)
+        if obj is None or not obj.interned:
+            return obj
+        copy = type(obj)()
+        self._release(crd)
+        self._store(crd, copy)
+        self._track(copy, crd)
+        return copy
+
+    @staticmethod
+    def _freeze(value):
+        """
+        Converts an attribute value into a registry key. Unhashable values,
+        e.g. colors hacked into lists, are registered by their representation.
+        :param value: Attribute value
+        :return: Hashable registry key
+        """
+        try:
+            hash(value)
+        except TypeError:
+            return type(value).__name__, repr(value)
+        return value
+
+    def _unregister(self, key, obj):
+        """
+        Removes an object from the registry of a given attribute
+        :param key: Registry attribute
+        :param obj: Registered object
+        :return: None
+        """
+        registry = self.registries[key]
+        value = self._freeze(getattr(obj, key, None))
+        if obj.id not in registry.get(value, {}):
+            # The value was mutated in place since it was registered
+            value = next(val for val, bucket in registry.items() if obj.id in bucket)
+        del registry[value][obj.id]
+        if not registry[value]:
+            del registry[value]
+
+    def _track(self, obj, crd):
+        """
+        Adds an object placed on the grid to the index and registries
+        :param obj: Placed object
+        :param crd: Coordinates of the object
+        :return: None
+        """
+        if obj.interned:
+            cells = self.shared_positions.setdefault(obj.id, set())
+            cells.add(tuple(crd))
+            if len(cells) > 1:
+                return
+        else:
+            self.positions[obj.id] = tuple(crd)
+        for key, registry in self.registries.items():
+            registry.setdefault(self._freeze(getattr(obj, key, None)), {})[obj.id] = obj
+
+    def _untrack(self, obj):
+        """
+        Removes an object taken off the grid from the index and registries
+        :param obj: Removed object
+        :return: None
+        """
+        del self.positions[obj.id]
+        for key in self.registries:
+            self._unregister(key, obj)
+
+    def query(self, within=None, **kwargs):
+        """
+        Returns coordinates of all objects which match all search conditions.
+        Conditions on registered attributes (Grid.REGISTRY_KEYS) are resolved
+        through the registries, other attributes are compared on the remaining
+        candidates only. An object matches once, regardless of the number of conditions.
+        :param within: Optional search area ((x1, y1), (x2, y2)), x2 and y2 excluded
+        :param kwargs: Search parameters in attribute=value pairs.
+        :return: A sorted list of (x, y) coordinate tuples of matching objects
+        """
+        if 'id' in kwargs:
+            crd = self.locate(kwargs.pop('id'))
+            candidates = [] if crd is None else [self.get(crd)]
+        else:
+            buckets = [self.registries[key].get(self._freeze(value), {})
+                       for key, value in kwargs.items() if key in self.registries]
+            if buckets:
+                candidates = min(buckets, key=len).values()
+            elif within is not None:
+                (x1, y1), (x2, y2) = within
+                candidates = [self.get((x, y)) for x in range(max(x1, 0), min(x2, self.width))
+                              for y in range(max(y1, 0), min(y2, self.height))]
+            else:
+                candidates = [obj for bucket in self.registries['type'].values() for obj in bucket.values()]
+
+        ret = []
+        seen = set()
+        for obj in candidates:
+            if obj is None or id(obj) in seen:
+                continue
+            seen.add(id(obj))
+            if any(getattr(obj, key, None) != value for key, value in kwargs.items()):
+                continue
+            for crd in self._cells_of(obj):
+                if within is None or (within[0][0] <= crd[0] < within[1][0]
+                                      and within[0][1] <= crd[1] < within[1][1]):
+                    ret.append(crd)
+        ret.sort()
+        return ret
+
+    def _cells_of(self, obj):
+        """
+        Returns coordinates of all squares holding an object
+        :param obj: The object
+        :return: A collection of (x, y) coordinates
+        """
+        if obj.interned:
+            return self.shared_positions.get(obj.id, ())
+        crd = self.positions.get(obj.id)
+        return () if crd is None or self.get(crd) is not obj else (crd,)
+
     def match(self, **kwargs):
         """
         Returns coordinates of all objects, that match search conditions.
@@ -45,13 +322,7 @@ class Grid:
         :param kwargs: Search parameters in attribute=value pairs.
         :return: A list of (x, y) coordinate tuples of matching objects
         """
-        ret = []
-        for x, col in enumerate(self.grid):
-            for y, obj in enumerate(col):
-                for key, value in kwargs.items():
-                    if getattr(obj, key) == value:
-                        ret.append((x, y))
-        return ret
+        return self.query(**kwargs)
 
     def find(self, **kwargs):
         """
@@ -138,9 +409,131 @@ class Grid:
         :return: None
         """
         if isinstance(obj, type):
-            self.grid[crd[0]][crd[1]] = obj(**kwargs)
-        else:
-            self.grid[crd[0]][crd[1]] = obj
+            obj = self.instantiate(obj, **kwargs)
+        self._release(crd)
+        self._store(crd, obj)
+        self.touch(tuple(crd))
+        if obj is not None:
+            if obj.id in self.positions and not obj.interned:
+                self._untrack(obj)
+            self._track(obj, crd)
+
+    def _release(self, crd):
+        """
+        Takes the object placed on a given square off the index and registries
+        :param crd: Coordinates of the square
+        :return: None
+        """
+        old = self.get(crd)
+        if old is None:
+            return
+        if old.interned:
+            cells = self.shared_positions.get(old.id)
+            if cells and tuple(crd) in cells:
+                cells.discard(tuple(crd))
+                if not cells:
+                    del self.shared_positions[old.id]
+                    for key in self.registries:
+                        self._unregister(key, old)
+        elif self.positions.get(old.id) == tuple(crd):
+            self._untrack(old)
+
+    def _store(self, crd, obj):
+        """
+        Writes an object into the grid storage, without any bookkeeping
+        :param crd: Coordinates of the square
+        :param obj: Stored object
+        :return: None
+        """
+        self.grid[crd[0]][crd[1]] = obj
+
+    def fill(self, obj, **kwargs):
+        """
+        Places an object on every square of the grid
+        :param obj: Object prototype, a new instance is placed on each square
+        :param kwargs: Object attributes
+        :return: None
+        """
+        for x in range(self.width):
+            for y in range(self.height):
+                self.place_object_f((x, y), obj, **kwargs)
+        self.touch_all()
+
+    def paint(self, within, mask, on, off):
+        """
+        Places one of two objects on each square of an area
+        :param within: Area of the grid ((x1, y1), (x2, y2)), x2 and y2 excluded
+        :param mask: Boolean array of shape (x2 - x1, y2 - y1), indexed [x][y]
+        :param on: Object prototype placed on squares where the mask is True
+        :param off: Object prototype placed on the other squares
+        :return: None
+        """
+        index = mask.astype(int) if hasattr(mask, 'astype') else [[int(v) for v in row] for row in mask]
+        self.paint_kinds(within, index, (off, on))
+
+    def paint_kinds(self, within, index, prototypes):
+        """
+        Places an object prototype chosen by an index array on each square of an area
+        :param within: Area of the grid ((x1, y1), (x2, y2)), x2 and y2 excluded
+        :param index: Integer array of shape (x2 - x1, y2 - y1), indexed [x][y]
+        :param prototypes: Sequence of object prototypes, indexed by the values of index
+        :return: None
+        """
+        (x1, y1), (x2, y2) = within
+        rows = index.tolist() if hasattr(index, 'tolist') else index
+        for x, row in zip(range(x1, x2), rows):
+            for y, value in zip(range(y1, y2), row):
+                self.place_object_f((x, y), prototypes[value])
+
+    def passable_mask(self, name=None, keys=(), within=None):
+        """
+        Returns which squares of an area moving objects can enter, ignoring moving
+        objects on the squares (see pathfinding.enterable)
+        :param name: Name of the moving objects, None to only include squares passable for all
+        :param keys: (name, color) pairs of items carried by the moving objects
+        :param within: Optional area ((x1, y1), (x2, y2)), x2 and y2 excluded.
+        The whole grid is used by default
+        :return: Boolean NumPy array of shape (x2 - x1, y2 - y1), indexed [x, y]
+        """
+        (x1, y1), (x2, y2) = self._clip(within or ((0, 0), (self.width, self.height)))
+        cls = (name, keys)
+        mask = [enterable(self.grid[x][y], cls) for x in range(x1, x2) for y in range(y1, y2)]
+        return np.array(mask, dtype=bool).reshape(max(x2 - x1, 0), max(y2 - y1, 0))
+
+    def _clip(self, within):
+        """
+        Limits an area to the grid
+        :param within: Area ((x1, y1), (x2, y2)), x2 and y2 excluded
+        :return: Area within the grid
+        """
+        (x1, y1), (x2, y2) = within
+        return (max(x1, 0), max(y1, 0)), (min(x2, self.width), min(y2, self.height))
+
+    def prefetch(self, within):
+        """
+        Hints that the squares of an area and the squares around moving objects will be
+        used soon. Grids which keep all squares in memory ignore it.
+        :param within: Area of the grid ((x1, y1), (x2, y2)), x2 and y2 excluded
+        :return: None
+        """
+        return None
+
+    def glyphs(self, within=None):
+        """
+        Returns what should be displayed on the squares of a given area
+        :param within: Optional area ((x1, y1), (x2, y2)), x2 and y2 excluded.
+        The whole grid is used by default
+        :return: Iterable of (x, y, symbol, color) tuples, symbol and color
+        are None for squares with no object
+        """
+        (x1, y1), (x2, y2) = within or ((0, 0), (self.width, self.height))
+        for x in range(max(x1, 0), min(x2, self.width)):
+            for y in range(max(y1, 0), min(y2, self.height)):
+                obj = self.grid[x][y]
+                if obj is None:
+                    yield x, y, None, None
+                else:
+                    yield x, y, obj.symbol, obj.color
 
     @staticmethod
     def get_adjacent(crd):
@@ -159,21 +552,115 @@ class Grid:
     def get_player(self):
         """
         Returns the player object.
-        :return: Player object
+        :return: Player object, None if there is no player on the grid
         """
-        for col in self.grid:
-            for entity in col:
-                if entity.type == Type.PLAYER:
-                    return entity
-        return None
+        players = self.registries['type'].get(Type.PLAYER)
+        return next(iter(players.values())) if players else None
 
     def get_dynamic_objects(self):
         """
-        Returns a list of (x, y) coordinates of all dynamic objects
-        on the grid
-        :return: A list of (x, y) coordinates of all dynamic objects on the grid
+        Returns a snapshot of all dynamic objects on the grid, in order of placement.
+        Objects moved or removed while the snapshot is processed are listed exactly once.
+        :return: A list of all dynamic objects on the grid
         """
-        for x, col in enumerate(self.grid):
-            for y, obj in enumerate(col):
-                if obj.type == Type.DYNAMIC:
-                    yield x, y
+        return self.registered('type', Type.DYNAMIC)
+
+    def distance_map(self, target, cls):
+        """
+        Returns the distances of the squares around a target to the target, for moving objects
+        of a passability class. Maps are cached by target square and shared by all objects
+        chasing the same target.
+        :param target: (x, y) coordinates of the target square
+        :param cls: Passability class of the moving objects, see pathfinding.passability_class()
+        :return: pathfinding.FlowField
+        """
+        if self.distance_maps is None:
+            self.distance_maps = DistanceCache(self)
+        return self.distance_maps.get(target, cls)
+
+    def seed(self, value):
+        """
+        Seeds the random generator used by objects on the grid
+        :param value: Integer seed
+        :return: None
+        """
+        self.rng.seed(value)
+
+    def state_hash(self):
+        """
+        Returns a digest of the state of all objects on the grid: the class of the object on
+        each square, and the fields of placed objects which differ from the defaults of their class.
+        Object ids are not included, so equal states hash equally regardless of object creation
+        order and of the grid backend. Every square is read, so it is meant for checkpoints only.
+        :return: Hex digest of 32 characters
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        self._hash_squares(digest)
+        state = []
+        for crd in sorted(self.positions.values()):
+            obj = self.get(crd)
+            fields = self._changed_fields(obj)
+            if fields:
+                state.append((crd, fields))
+        digest.update(repr(state).encode())
+        return digest.hexdigest()
+
+    def _hash_squares(self, digest):
+        """
+        Adds the class names of the objects on all squares to a state digest, as a sorted
+        table of names followed by an array of indices into it, indexed [x, y]
+        :param digest: hashlib digest
+        :return: None
+        """
+        kinds = [type(obj).__name__ if obj is not None else '' for column in self.grid for obj in column]
+        names = sorted(set(kinds))
+        index = {name: i for i, name in enumerate(names)}
+        digest.update(repr(names).encode())
+        digest.update(np.array([index[kind] for kind in kinds], dtype=np.uint16).tobytes())
+
+    @classmethod
+    def _changed_fields(cls, obj):
+        """
+        Returns the fields of an object which differ from the defaults of its class
+        :param obj: The object
+        :return: A tuple of (field, canonical value) pairs
+        """
+        return tuple((key, cls._canonical(getattr(obj, key))) for key, default in obj.schema.items()
+                     if key not in ('id', 'interned', 'coords') and getattr(obj, key) != default)
+
+    @classmethod
+    def _canonical(cls, value):
+        """
+        Converts an attribute value into a representation independent of object ids
+        :param value: Attribute value or an object
+        :return: Nested tuples of plain values
+        """
+        if hasattr(value, 'info'):
+            return type(value).__name__, tuple((key, cls._canonical(val)) for key, val in value.info().items()
+                                               if key not in ('id', 'coords'))
+        if isinstance(value, (list, tuple)):
+            return tuple(cls._canonical(val) for val in value)
+        if isinstance(value, (set, frozenset)):
+            return tuple(sorted(repr(cls._canonical(val)) for val in value))
+        if isinstance(value, dict):
+            return tuple(sorted((repr(key), repr(cls._canonical(val))) for key, val in value.items()))
+        return value
+
+
+def create_grid(backend='list', width=10, height=10, **kwargs):
+    """
+    Creates a grid with a given storage backend
+    :param backend: 'list' for Grid, 'array' for the NumPy backed ArrayGrid,
+    'chunked' for the memory-mapped ChunkedGrid
+    :param width: Width of the grid in squares
+    :param height: Height of the grid in squares
+    :param kwargs: Additional backend parameters, e.g. flyweight
+    :return: The new grid
+    """
+    if backend == 'array':
+        from array_grid import ArrayGrid
+        return ArrayGrid(width, height, **kwargs)
+    if backend == 'chunked':
+        from chunk_grid import ChunkedGrid
+        return ChunkedGrid(width, height, **kwargs)
+    return Grid(width, height, **kwargs)
@@ -3,12 +3,20 @@ This file contains the Game class, which manipulates elements
 of the grid. Run this file to initialize the game.
 """
 
+import os
+import sys
+import time
+from io import StringIO
 import pygame
 import objects
-from objects import grid
 from constants import Colors, Events
 from config import CONSOLE_CONFIG
-from libs.pygame_console.game_console import Console
+from glyphs import GlyphCache
+from scheduler import Scheduler
+from profiler import Profiler
+from replay import Recorder, ReplayError, read_log
+import levels
+from libs.pygame_console.game_console import Console, CommandLineProcessor
 
 
 class Game:
@@ -16,30 +24,61 @@ class Game:
     Main class which manipulates all game events
     """
 
-    def __init__(self, level=1, screen_width=1200, screen_height=900):
+    def __init__(self, level=1, screen_width=1200, screen_height=900, headless=False):
         """
         :param screen_width: Screen width in pixels
         :param screen_height: Screen height in pixels
+        :param headless: If True, only the game logic runs: no display, surfaces
+        nor console are created. Use Game.simulate() to feed the input.
         """
         self.screen_width = screen_width
         self.screen_height = screen_height
         self.top_taskbar_h = 180
         self.running = True
+        self.headless = headless
+        self.level = level
+        self.scheduler = None
+        # Per-frame instrumentation, shown by the F2 overlay and the console stats command
+        self.profiler = Profiler()
+        objects.grid.profiler = self.profiler
+        self.show_stats = False
+        self.stats_drawn = 0
+        # Input log writer, see Game.record()
+        self.recorder = None
+        # Size of the game surface in pixels
+        self.game_size = (600, 600)
+
+        if headless:
+            self.window = None
+            self.console = None
+            self.updated_rects = []
+            return
 
         pygame.init()
         pygame.display.set_caption("Pytrusted")
         self.window = pygame.display.set_mode((self.screen_width, self.screen_height))
+        # Areas of the window changed since the last display update
+        self.updated_rects = [self.window.get_rect()]
         self.font = pygame.font.SysFont('couriernew', 30)
+        self.grid_font = pygame.font.SysFont('cambria', 30)
+        self.stats_font = pygame.font.SysFont('couriernew', 14)
+
+        # Pre-rendered symbols of the grid and of the inventory
+        self.glyphs = GlyphCache(self.grid_font)
+        self.glyphs.build_atlas(self.known_symbols())
+        self.inventory_glyphs = GlyphCache(self.font)
 
         self.taskbar_top_surf = pygame.Surface((self.screen_width, self.top_taskbar_h))
         self.taskbar_top_surf.fill(Colors.MD_GRAY)
-        self.game_surf = pygame.Surface((600, 600))
+        self.game_surf = pygame.Surface(self.game_size)
         self.game_surf.fill(Colors.MD_GRAY)
         self.code_surf = pygame.Surface((600, 600))
         self.code_surf.fill(Colors.BLACK)
+        self.game_pos = (0, self.top_taskbar_h)
+        self.code_pos = (600, self.top_taskbar_h)
 
-        self.window.blit(self.game_surf, (0, self.top_taskbar_h))
-        self.window.blit(self.code_surf, (600, self.top_taskbar_h))
+        self.window.blit(self.game_surf, self.game_pos)
+        self.window.blit(self.code_surf, self.code_pos)
 
         self.inv_box = pygame.Surface((250, 70))
         self.inv_box.fill(Colors.WHITE)
@@ -52,29 +91,113 @@ class Game:
         self.taskbar_top_surf.blit(inv_text, (30, 30))
         self.window.blit(self.taskbar_top_surf, (0, 0))
 
-        self.console = Console(grid, 600, CONSOLE_CONFIG)
+        self.console = Console(objects.grid, 600, CONSOLE_CONFIG)
         # self.console.toggle()
 
-        self.level = level
-
     def draw(self):
         """
-        Draws the object symbols and blits them onto the window
+        Draws the symbols of squares changed since the last call and blits
+        them onto the window. Only the changed areas are marked for display update.
+        :return: None
+        """
+        grid = objects.grid
+        redraw_all, squares = grid.take_dirty()
+        self.profiler.count('dirty', len(squares))
+        surf_rect = self.game_surf.get_rect()
+        if redraw_all:
+            self.game_surf.fill(Colors.BLACK)
+            self.draw_glyphs(self.viewport())
+            areas = [surf_rect]
+        else:
+            areas = []
+            for x, y in squares:
+                # Symbols can overflow their squares, so the neighbors are redrawn
+                # within half a square around the changed one
+                area = pygame.Rect(0, 0, 2 * grid.field_width, 2 * grid.field_height)
+                area.center = (x * grid.field_width + grid.margin_left,
+                               y * grid.field_height + grid.margin_top)
+                area = area.clip(surf_rect)
+                if not area:
+                    continue
+                self.game_surf.set_clip(area)
+                self.game_surf.fill(Colors.BLACK)
+                self.draw_glyphs(((x - 1, y - 1), (x + 2, y + 2)))
+                areas.append(area)
+            self.game_surf.set_clip(None)
+
+        for area in areas:
+            self.window.blit(self.game_surf, area.move(self.game_pos), area)
+            self.updated_rects.append(area.move(self.game_pos))
+        self.profiler.count('blits', len(areas))
+
+    def viewport(self):
+        """
+        Returns the area of the grid shown on the game surface
+        :return: Area ((x1, y1), (x2, y2)), x2 and y2 excluded
+        """
+        grid = objects.grid
+        return (0, 0), (self.game_size[0] // grid.field_width + 1, self.game_size[1] // grid.field_height + 1)
+
+    def draw_glyphs(self, within):
+        """
+        Blits symbols of the squares in a given area onto the game surface
+        :param within: Area of the grid ((x1, y1), (x2, y2)), x2 and y2 excluded
+        :return: None
+        """
+        grid = objects.grid
+        blits = []
+        for x, y, sym, col in grid.glyphs(within=within):
+            if sym is None:
+                sym, col = ".", Colors.ORANGE
+            char = self.glyphs.get(sym, col)
+            char_rect = char.get_rect()
+            char_rect.center = (x * grid.field_width + grid.margin_left,
+                                y * grid.field_height + grid.margin_top)
+            blits.append((char, char_rect))
+        self.game_surf.blits(blits, doreturn=False)
+        self.profiler.count('blits', len(blits))
+
+    def draw_stats(self, interval=500):
+        """
+        Displays the profiler statistics on the right side of the top taskbar
+        :param interval: Minimal time in ms between two updates of the statistics
+        :return: None
+        """
+        now = pygame.time.get_ticks()
+        if self.show_stats and now - self.stats_drawn < interval:
+            return
+        self.stats_drawn = now
+        area = pygame.Rect(self.screen_width - 560, 0, 560, self.top_taskbar_h)
+        self.taskbar_top_surf.fill(Colors.MD_GRAY, area)
+        if self.show_stats:
+            for i, line in enumerate(self.profiler.lines()):
+                text = self.stats_font.render(line, True, Colors.WHITE)
+                self.taskbar_top_surf.blit(text, (area.x + 10, area.y + 10 + 18 * i))
+        self.window.blit(self.taskbar_top_surf, area.topleft, area)
+        self.updated_rects.append(area)
+
+    def toggle_stats(self):
+        """
+        Shows or hides the profiler statistics overlay
         :return: None
         """
-        self.font = pygame.font.SysFont('cambria', 30)
-        for x in range(grid.width):
-            for y in range(grid.height):
-                obj = grid.grid[x][y]
-                sym = obj.symbol if obj is not None else "."
-                col = obj.color if obj is not None else Colors.ORANGE
-                char = self.font.render(sym, True, col)
-                char_rect = char.get_rect()
-                char_rect.center = (x * grid.field_width + grid.margin_left,
-                                    y * grid.field_height + grid.margin_top)
-                self.game_surf.blit(char, char_rect)
+        if self.headless:
+            return
+        self.show_stats = not self.show_stats
+        self.stats_drawn = 0
+        # Hiding the overlay clears its area
+        if not self.show_stats:
+            self.draw_stats()
 
-        self.window.blit(self.game_surf, (0, self.top_taskbar_h))
+    @staticmethod
+    def known_symbols():
+        """
+        Returns the symbols which objects display by default
+        :return: A list of symbols
+        """
+        symbols = [cls.schema['symbol'] for cls in vars(objects).values() if isinstance(cls, objects.Schema)]
+        # Empty squares and the turned player
+        return symbols + [".", "◀", "▶", "▲", "▼"]
 
     @staticmethod
     def disable_console():
@@ -84,17 +207,15 @@ class Game:
         """
         e = pygame.event.Event(Events.CONSOLE_TOGGLE, on=False)
         e.dict['on'] = False
-        pygame.event.post(e)
+        objects.grid.post(e)
 
     @staticmethod
     def clear_grid():
         """
-        Places an Empty() object on each square
+        Places an Empty object on each square
         :return: None
         """
-        for x in range(grid.width):
-            for y in range(grid.height):
-                grid.place_object_f((x, y), objects.Empty())
+        objects.grid.fill(objects.Empty)
 
     def display_inventory(self, inv_):
         """
@@ -104,18 +225,20 @@ class Game:
         :type inv_: list
         :return: None
         """
+        if self.headless:
+            return
         inv = inv_ + [None for _ in range(len(self.item_boxes) - len(inv_))]
-        self.font = pygame.font.SysFont('couriernew', 30)
         self.inv_box.fill(Colors.WHITE)
         for i, box in enumerate(self.item_boxes):
             s = inv[i].symbol if inv[i] is not None else "-"
             c = inv[i].color if inv[i] is not None else Colors.WHITE
-            sym = self.font.render(s, True, c)
+            sym = self.inventory_glyphs.get(s, c)
             box.fill(Colors.D_GRAY)
             box.blit(sym, (15, 10))
             self.inv_box.blit(box, (10 + 60 * i, 10))
         self.taskbar_top_surf.blit(self.inv_box, (30, 70))
         self.window.blit(self.taskbar_top_surf, (0, 0))
+        self.updated_rects.append(self.taskbar_top_surf.get_rect())
 
     @staticmethod
     def place_from_map(_map, code):
@@ -134,61 +257,255 @@ class Game:
         for y, row in enumerate(_map):
             for x, char in enumerate(row):
                 ref = code[char]
-                obj = None
                 if isinstance(ref, str):
-                    obj = objects.__dict__[ref]()
-                elif isinstance(ref, type):
-                    obj = ref()
-                else:
-                    obj = ref
-                grid.place_object((x, y), obj)
-
-    def tick(self, delay):
-        """
-        Main loop function which handles PyGame Events, processes objects on the
-        grid, and displays the symbols on the screen.
-        :param delay: Duration of one tick
+                    ref = objects.__dict__[ref]
+                objects.grid.place_object((x, y), ref)
+
+    def tick(self):
+        """
+        Runs one frame of the main loop: waits for events until the frame is due
+        (see Scheduler.wait), processes objects on the grid, and displays the symbols on the screen.
+        :return: None
+        """
+        if self.scheduler is None:
+            self.scheduler = Scheduler()
+        events = self.scheduler.wait(idle=False)
+        self.profiler.start_frame()
+        self.step(events)
+        self.render(events)
+        self.profiler.end_frame()
+        self.scheduler.end_frame()
+
+    def run(self, fps=60, step_rate=30):
+        """
+        Main loop. Blocks for events while nothing changes on the screen, processes
+        input in fixed-rate simulation steps and renders at most fps frames per second.
+        The frame budget statistics are available from self.scheduler.report(),
+        the time spent in phases of the frames from self.profiler.report().
+        :param fps: Maximal number of rendered frames per second
+        :param step_rate: Number of simulation steps per second
+        :return: None
+        """
+        self.scheduler = Scheduler(fps, step_rate)
+        pending = []
+        while self.running:
+            events = self.scheduler.wait(idle=not pending and self.idle())
+            self.profiler.start_frame()
+            pending += events
+            for _ in range(self.scheduler.due_steps()):
+                self.step(pending)
+                pending = []
+            self.render(events)
+            self.profiler.end_frame()
+            self.scheduler.end_frame()
+
+    def simulate(self, inputs):
+        """
+        Runs the game logic on a scripted input stream, one step per input, without
+        rendering. Events posted by objects are handled until none are left.
+        :param inputs: Iterable of key codes (pressed and released) or PyGame events
+        :return: Number of steps run
+        """
+        steps = 0
+        for item in inputs:
+            if not self.running:
+                break
+            if isinstance(item, int):
+                events = [pygame.event.Event(pygame.KEYDOWN, key=item),
+                          pygame.event.Event(pygame.KEYUP, key=item)]
+            else:
+                events = [item]
+            self.profiler.start_frame()
+            self.step(events)
+            self.profiler.end_frame()
+            steps += 1
+        while objects.grid.events and self.running:
+            self.profiler.start_frame()
+            self.step([])
+            self.profiler.end_frame()
+            steps += 1
+        return steps
+
+    def start_level(self, level, seed):
+        """
+        Loads a level with the grid random generator in a given state
+        :param level: Number of the level
+        :param seed: Seed of the grid random generator
         :return: None
         """
-        pygame.time.delay(delay)
+        objects.grid.seed(seed)
+        objects.grid.take_events()
+        self.level = level
+        self.load_level(level)
+
+    def load_level(self, level):
+        """
+        Loads a level from its compiled file (see levels.py). Runs the level method
+        if the file is missing or doesn't match the method or the grid.
+        :param level: Number of the level
+        :return: None
+        :raises AttributeError: If the level has neither a usable file nor a method
+        """
+        if not levels.load_level(self, level):
+            getattr(self, "level" + str(level))()
+
+    def record(self, path, seed=None, checkpoint_every=50):
+        """
+        Starts recording the input into a log, which can be played back with Game.replay().
+        The current level is reloaded, so that the recording starts from a known state.
+        :param path: Path of the log file
+        :param seed: Seed of the grid random generator, random by default
+        :param checkpoint_every: Number of recorded steps between two grid state checkpoints
+        :return: None
+        """
+        self.stop_recording()
+        if seed is None:
+            seed = int.from_bytes(os.urandom(8), 'little')
+        self.start_level(self.level, seed)
+        self.recorder = Recorder(path, seed, self.level, objects.grid, checkpoint_every)
+        if self.console is not None:
+            self.console.on_command = self.recorder.command
+
+    def stop_recording(self):
+        """
+        Finishes the current recording, if there is one
+        :return: None
+        """
+        if self.recorder is None:
+            return
+        self.recorder.close()
+        self.recorder = None
+        if self.console is not None:
+            self.console.on_command = None
+
+    def replay(self, path, check=True):
+        """
+        Plays back an input log at full speed, without rendering
+        :param path: Path of the log file
+        :param check: If True, grid state hashes are compared at the checkpoints of the log
+        :return: A dict with the numbers of steps, commands and checkpoints, the duration
+        in seconds and the number of steps per second
+        :raises ReplayError: If the replayed state differs from the recorded one at a checkpoint
+        """
+        seed, level, entries = read_log(path)
+        self.stop_recording()
+        self.start_level(level, seed)
+        # Console commands are processed without the console, their output is dropped
+        cli = CommandLineProcessor(objects.grid, output=StringIO())
+
+        steps = commands = checkpoints = 0
+        start = time.perf_counter()
+        for entry in entries:
+            if entry[0] == 'step':
+                self.step(entry[1])
+                steps += 1
+            elif entry[0] == 'command':
+                cli.onecmd(entry[1])
+                commands += 1
+            elif check:
+                state = objects.grid.state_hash()
+                if state != entry[2]:
+                    raise ReplayError(f"State differs at step {entry[1]}: recorded {entry[2]}, replayed {state}")
+                checkpoints += 1
+        seconds = time.perf_counter() - start
+        return {
+            'steps': steps,
+            'commands': commands,
+            'checkpoints': checkpoints,
+            'seconds': seconds,
+            'steps_per_s': steps / seconds if seconds else 0
+        }
+
+    def idle(self):
+        """
+        Checks if the screen stays the same until new events arrive
+        :return: True if there is nothing to redraw, False otherwise
+        """
+        grid = objects.grid
+        return (not grid.redraw_all and not grid.dirty and not self.updated_rects and not grid.events
+                and not self.console.enabled and getattr(self.console, 'anim_perc', 0) == 0)
 
-        events = pygame.event.get()
-        for event in events:
+    def step(self, events):
+        """
+        Simulation step, which handles PyGame Events and processes objects on the grid
+        :param events: A list of PyGame events
+        :return: None
+        """
+        posted = bool(objects.grid.events)
+        with self.profiler.phase('events'):
+            self.handle_events(events)
+        with self.profiler.phase('paging'):
+            objects.grid.prefetch(self.viewport())
+        if self.recorder is not None:
+            self.recorder.step(events, posted)
+
+    def handle_events(self, events):
+        """
+        Handles PyGame Events of a simulation step
+        :param events: A list of PyGame events
+        :return: None
+        """
+        grid = objects.grid
+        # Events posted by objects during the previous step
+        for event in grid.take_events() + list(events):
             if event.type == pygame.QUIT:
                 self.running = False
 
             if event.type == pygame.KEYDOWN:
-                print(event.key)
-                p = grid.get_player()
-                p.behavior(event.key)
-                self.display_inventory(p.inventory)
-
-                for obj_coords in grid.get_dynamic_objects():
-                    grid.get(obj_coords).behavior(event.key)
+                with self.profiler.phase('player'):
+                    p = grid.get_player()
+                    p.behavior(event.key)
+                    self.display_inventory(p.inventory)
+
+                with self.profiler.phase('objects'):
+                    for obj in grid.get_dynamic_objects():
+                        # Skip objects taken off the grid by the ones processed before
+                        if grid.locate(obj.id) is not None:
+                            obj.behavior(event.key)
+                            self.profiler.count('objects')
 
             if event.type == pygame.KEYUP:
-                if event.key == pygame.K_F1:
+                if event.key == pygame.K_F1 and self.console is not None:
                     self.console.toggle()
 
+                if event.key == pygame.K_F2:
+                    self.toggle_stats()
+
                 if event.key == pygame.K_q:
-                    getattr(self, "level" + str(self.level))()
+                    self.load_level(self.level)
 
             if event.type == Events.LEVEL:
-                getattr(self, event.dict['target'])()
-
-            if event.type == Events.CONSOLE_TOGGLE:
-                if event.dict['on']:
-                    self.console.enabled = True
-                else:
-                    self.disable_console()
+                self.load_level(int(event.dict['target'][len("level"):]))
 
-        self.game_surf.fill(Colors.BLACK)
-        self.draw()
+            if event.type == Events.CONSOLE_TOGGLE and self.console is not None:
+                if event.dict['on'] != self.console.enabled:
+                    self.console.toggle()
 
-        self.console.update(events)
-        self.console.show(self.code_surf)
-        self.window.blit(self.code_surf, (600, self.top_taskbar_h))
-        pygame.display.update()
+    def render(self, events):
+        """
+        Render step, which displays the changed squares and the console on the screen
+        :param events: A list of PyGame events, used for the console input
+        :return: None
+        """
+        if self.headless:
+            return
+        with self.profiler.phase('draw'):
+            self.draw()
+            if self.show_stats:
+                self.draw_stats()
+
+        with self.profiler.phase('console'):
+            self.console.update(events)
+            # The console area only changes while the console is shown or being hidden
+            if self.console.enabled or getattr(self.console, 'anim_perc', 0) > 0:
+                self.console.show(self.code_surf)
+                self.window.blit(self.code_surf, self.code_pos)
+                self.updated_rects.append(self.code_surf.get_rect(topleft=self.code_pos))
+                self.profiler.count('blits')
+
+        with self.profiler.phase('display'):
+            pygame.display.update(self.updated_rects)
+        self.updated_rects = []
 
     def level1(self):
         """
@@ -335,7 +652,7 @@ class Game:
                                 ".": 'Empty',
                                 "#": 'Wall',
                                 "p": objects.Player(),
-                                "k": objects.SmallKey(color=Colors.AQUA, hackable=['color']),
+                                "k": objects.HackableKey(color=Colors.AQUA),
                                 "d": objects.ColoredDoor(color=Colors.GREEN),
                                 "e": objects.Exit(target_level="level6"),
                                 "c": objects.Computer()
@@ -364,11 +681,9 @@ class Game:
                                 ".": 'Empty',
                                 "#": 'Wall',
                                 "p": objects.Player(),
-                                "k": objects.SmallKey(color=Colors.AQUA, hackable=[]),
-                                "d": objects.ColoredDoor(color=Colors.SCARLET, hackable=['color']),
-                                "D": objects.ColoredDoor(color=Colors.AQUA,
-                                                         required_key_name="big_key",
-                                                         hackable=['required_key_name']),
+                                "k": objects.SmallKey(color=Colors.AQUA),
+                                "d": objects.HackableDoor(color=Colors.SCARLET),
+                                "D": objects.LockedDoor(color=Colors.AQUA, required_key_name="big_key"),
                                 "e": objects.Exit(target_level="level6"),
                                 "c": objects.Computer(),
                             })
@@ -410,13 +725,20 @@ class Game:
                                 "c": objects.Computer(),
                                 "M": objects.MazeGenerator(working_area=((2, 5), (23, 17)),
                                                            path_str=((3, 5), "ddrrrrrdrrrurr"),
-                                                           density=0.8,
-                                                           hackable=['path_str'])
+                                                           density=0.8)
                             })
 
 
 if __name__ == "__main__":
+    # python init.py [--record LOG | --replay LOG]
+    if len(sys.argv) == 3 and sys.argv[1] == "--replay":
+        game = Game(5, headless=True)
+        print(game.replay(sys.argv[2]))
+        sys.exit()
+
     game = Game(5)
-    getattr(game, "level"+str(game.level))()
-    while game.running:
-        game.tick(30)
+    game.load_level(game.level)
+    if len(sys.argv) == 3 and sys.argv[1] == "--record":
+        game.record(sys.argv[2])
+    game.run()
+    game.stop_recording()
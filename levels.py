@@ -0,0 +1,242 @@
+"""
+This file contains the level compiler and loader.
+
+A compiled level is an npz file with:
+    tiles - uint8 array of shape (width, height), indices into tile_names
+    tile_names - class names of the default objects placed on the squares
+    meta - JSON: level number, grid seed used by the compiler, source hash of the level method
+           and of the object class defaults,
+           entity table (class, coordinates and non-default fields of each
+           other object, in order of placement) and the events posted by the level
+
+A compiled level is complete, so levels can live outside init.py as npz files only.
+When the Game has a method for the level, the file is used only if it was compiled
+from the current source of the method, otherwise the file is stale and the method runs.
+Random numbers drawn by a level method while it is compiled are stored with the level,
+so a loaded level is the same for every seed of the game.
+
+Run this file to compile all levels of the Game into the levels directory:
+    python levels.py
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import sys
+
+import numpy as np
+import pygame
+import objects
+from constants import Events
+
+LEVEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'levels')
+# Seed of the grid random generator while a level is compiled
+LEVEL_SEED = 0
+# Fields which are not saved, the position is stored in the entity table
+SKIPPED_FIELDS = ('id', 'interned', 'coords')
+
+# Path -> (modification time, tiles, tile names, meta) of loaded levels
+_loaded = {}
+# Level method -> source hash
+_sources = {}
+# Hash of the fields of all object classes, see source_hash()
+_classes = []
+
+
+def level_path(level):
+    """
+    Returns the path of a compiled level
+    :param level: Number of the level
+    :return: Path of the npz file
+    """
+    return os.path.join(LEVEL_DIR, f"level{level}.npz")
+
+
+def source_hash(game, level):
+    """
+    Returns a hash of the source of a level method and of the default fields of all object
+    classes (e.g. symbol, color, passable_for), used to detect outdated compiled levels
+    :param game: The Game
+    :param level: Number of the level
+    :return: Hex digest, None if the Game has no method for the level
+    """
+    if not _classes:
+        schemas = sorted((name, cls.flyweight, repr(cls.schema)) for name, cls in vars(objects).items()
+                         if isinstance(cls, objects.Schema))
+        _classes.append(repr(schemas))
+    method = getattr(type(game), "level" + str(level), None)
+    if method is None:
+        return None
+    if method not in _sources:
+        source = inspect.getsource(method) + _classes[0]
+        _sources[method] = hashlib.blake2b(source.encode(), digest_size=16).hexdigest()
+    return _sources[method]
+
+
+def encode(value):
+    """
+    Converts a field value into JSON compatible data
+    :param value: Field value, objects are encoded with their fields
+    :return: JSON compatible value
+    """
+    if isinstance(value, objects.Object):
+        if value.interned:
+            return {'shared': type(value).__name__}
+        return {'object': type(value).__name__, 'fields': encode_fields(value)}
+    if isinstance(value, tuple):
+        return {'tuple': [encode(val) for val in value]}
+    if isinstance(value, (set, frozenset)):
+        return {'set': [encode(val) for val in value]}
+    if isinstance(value, list):
+        return [encode(val) for val in value]
+    return value
+
+
+def decode(value):
+    """
+    Converts data created by encode() back into a field value
+    :param value: JSON compatible value
+    :return: Field value
+    """
+    if isinstance(value, list):
+        return [decode(val) for val in value]
+    if not isinstance(value, dict):
+        return value
+    if 'shared' in value:
+        return getattr(objects, value['shared']).shared()
+    if 'object' in value:
+        return getattr(objects, value['object']).restore(**decode_fields(value['fields']))
+    if 'tuple' in value:
+        return tuple(decode(val) for val in value['tuple'])
+    return {decode(val) for val in value['set']}
+
+
+def encode_fields(obj):
+    """
+    Returns the fields of an object which differ from the defaults of its class
+    :param obj: The object
+    :return: A dict of field: encoded value pairs
+    """
+    return {key: encode(getattr(obj, key)) for key, default in obj.schema.items()
+            if key not in SKIPPED_FIELDS and getattr(obj, key) != default}
+
+
+def decode_fields(fields):
+    """
+    Decodes the fields saved by encode_fields()
+    :param fields: A dict of field: encoded value pairs
+    :return: A dict of field: value pairs
+    """
+    return {key: decode(val) for key, val in fields.items()}
+
+
+def is_tile(obj):
+    """
+    Checks if an object can be stored as the default instance of its class
+    :param obj: The object
+    :return: True if the object is a tile, False otherwise
+    """
+    return obj is not None and (obj.interned or (type(obj).flyweight and not encode_fields(obj)))
+
+
+def compile_level(game, level, path=None):
+    """
+    Runs a level method on an empty grid, and saves the resulting grid
+    :param game: The Game
+    :param level: Number of the level
+    :param path: Path of the npz file, see level_path() by default
+    :return: Path of the npz file
+    """
+    grid = objects.grid
+    grid.seed(LEVEL_SEED)
+    grid.take_events()
+    grid.fill(objects.Empty)
+    getattr(game, "level" + str(level))()
+
+    tile_names = []
+    tiles = np.zeros((grid.width, grid.height), dtype=np.uint8)
+    for x in range(grid.width):
+        for y in range(grid.height):
+            obj = grid.get((x, y))
+            name = type(obj).__name__ if is_tile(obj) else 'Empty'
+            if name not in tile_names:
+                tile_names.append(name)
+            tiles[x, y] = tile_names.index(name)
+
+    # Index order is the order of placement, which decides the order of object behaviors
+    entities = []
+    for obj_id, (x, y) in grid.positions.items():
+        obj = grid.get((x, y))
+        if not is_tile(obj):
+            entities.append({'x': x, 'y': y, 'class': type(obj).__name__, 'fields': encode_fields(obj)})
+
+    events = [{'type': next(key for key, val in vars(Events).items() if val == event.type),
+               'dict': {key: encode(val) for key, val in event.dict.items()}} for event in grid.take_events()]
+    meta = {
+        'level': game.level,
+        'seed': LEVEL_SEED,
+        'source': source_hash(game, level),
+        'entities': entities,
+        'events': events
+    }
+
+    path = path or level_path(level)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        np.savez_compressed(file, tiles=tiles, tile_names=np.array(tile_names), meta=np.array(json.dumps(meta)))
+    return path
+
+
+def load_level(game, level, path=None):
+    """
+    Populates the grid with a compiled level. Files are read once and kept in memory.
+    The tiles are placed in bulk by Grid.paint_kinds(), the entities one by one.
+    :param game: The Game
+    :param level: Number of the level
+    :param path: Path of the npz file, see level_path() by default
+    :return: True if the level was loaded, False if the file is missing, if it is stale
+    (the Game has a method for the level, changed since the file was compiled),
+    or if it was compiled for a grid of another size
+    """
+    grid = objects.grid
+    path = path or level_path(level)
+    if not os.path.exists(path):
+        return False
+    stamp = os.path.getmtime(path)
+    cached = _loaded.get(path)
+    if cached is None or cached[0] != stamp:
+        with np.load(path) as data:
+            cached = _loaded[path] = (stamp, data['tiles'], [str(name) for name in data['tile_names']],
+                                      json.loads(str(data['meta'])))
+    _, tiles, tile_names, meta = cached
+    source = source_hash(game, level)
+    if (source is not None and meta['source'] != source) or tiles.shape != (grid.width, grid.height):
+        return False
+
+    prototypes = [getattr(objects, name) for name in tile_names]
+    grid.paint_kinds(((0, 0), tiles.shape), tiles, prototypes)
+    for entity in meta['entities']:
+        obj = getattr(objects, entity['class']).restore(**decode_fields(entity['fields']))
+        grid.place_object_f((entity['x'], entity['y']), obj)
+    for event in meta['events']:
+        grid.post(pygame.event.Event(getattr(Events, event['type']), decode_fields(event['dict'])))
+    grid.touch_all()
+    game.level = meta['level']
+    return True
+
+
+def compile_all(game):
+    """
+    Compiles all levels of the Game
+    :param game: The Game
+    :return: A list of paths of the compiled levels
+    """
+    numbers = sorted(int(key[5:]) for key in vars(type(game)) if key.startswith('level') and key[5:].isdigit())
+    return [compile_level(game, level) for level in numbers]
+
+
+if __name__ == '__main__':
+    from init import Game
+    for compiled in compile_all(Game(headless=True)):
+        print(compiled, file=sys.stdout)
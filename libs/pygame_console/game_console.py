@@ -44,6 +44,9 @@ import pygame # for Surface and graphics init
 import pygame.freetype # for all the fonts
 import pygame.locals as pl # for key names
 import cmd	# for command line support https://docs.python.org/3/library/cmd.html
+from contextlib import contextmanager # for batched console output
+from bisect import bisect_left, bisect_right # for looking up glyphs of the input text by their position
+from collections import Counter # for the vertical extent of the input text
 
 class Padding(tuple):
 	''' Class to facilitate easier and more understandable work 
@@ -68,6 +71,67 @@ class Padding(tuple):
 		self.right = padding[3] if len(padding) > 3 else 0
 
 
+class RingBuffer:
+	''' Fixed-capacity history of the last added items. Appending is O(1), once the
+	buffer is full every new item drops the oldest one. Items are accessed by indexing
+	(0 is the oldest item) or by window() for a range of items, e.g. the displayed lines.
+
+	e.g.
+		buf = RingBuffer(2)
+		buf.append('a'); buf.append('b'); buf.append('c')
+		buf[0] returns 'b'
+		buf.window(0, 5) returns ['b', 'c']
+	'''
+
+	def __init__(self, capacity):
+		''' :param capacity: Maximal number of stored items
+		'''
+		self.capacity = max(capacity, 0)
+		self.items = [None] * self.capacity
+		# Position of the oldest item in the items list
+		self.start = 0
+		self.length = 0
+		# Number of items ever appended, the oldest stored item is number total - length
+		self.total = 0
+
+	def append(self, item):
+		''' Adds an item after the newest one, dropping the oldest item if the buffer is full
+		'''
+		self.total += 1
+		if not self.capacity:
+			return
+		self.items[(self.start + self.length) % self.capacity] = item
+		if self.length < self.capacity:
+			self.length += 1
+		else:
+			self.start = (self.start + 1) % self.capacity
+
+	def clear(self):
+		''' Removes all items. Numbering of items continues, see total.
+		'''
+		self.items = [None] * self.capacity
+		self.start = 0
+		self.length = 0
+
+	def window(self, start, stop):
+		''' Returns a list of the items start to stop (excluded), limited to the stored items
+		'''
+		start, stop = max(start, 0), min(stop, self.length)
+		return [self.items[(self.start + i) % self.capacity] for i in range(start, stop)]
+
+	def __len__(self):
+		return self.length
+
+	def __getitem__(self, index):
+		if index < 0:
+			index += self.length
+		if not 0 <= index < self.length:
+			raise IndexError('RingBuffer index out of range')
+		return self.items[(self.start + index) % self.capacity]
+
+	def __iter__(self):
+		return iter(self.window(0, self.length))
+
 class CommandLineProcessor(cmd.Cmd):
 	"""
 	Class implementing the logic behind console commands.
@@ -198,7 +262,22 @@ class CommandLineProcessor(cmd.Cmd):
 		try:
 			player = self.app.get_player()
 			obj = self.app.get(player.looking_at)
-			self.output.write(str(obj.__dict__))
+			# List the declared fields of the object, hackable ones are marked with *
+			for field, value in obj.info().items():
+				self.output.write(('* ' if field in obj.hackable else '  ') + field + ' = ' + repr(value))
+		except Exception as e:
+			self.output.write(str(e))
+			return -1
+
+	def do_stats(self, params):
+		''' Prints frame time percentiles, time spent in phases of the last frame
+		and counts of processed objects and blits
+		'''
+		try:
+			if self.app.profiler is None:
+				raise Exception("ERROR: Profiling is not available")
+			for line in self.app.profiler.lines():
+				self.output.write(line)
 		except Exception as e:
 			self.output.write(str(e))
 			return -1
@@ -212,6 +291,8 @@ class CommandLineProcessor(cmd.Cmd):
 				raise Exception("ERROR: Missing argument")
 			if params[0] in obj.hackable:
 				val = eval(params[1])
+				# Shared objects are copied before they are changed
+				obj = self.app.writable(player.looking_at)
 				setattr(obj, params[0], val)
 				self.output.write("Success!")
 			else:
@@ -371,16 +452,28 @@ class Header:
 		if self.layout_name in ['SCROLL_LEFT_CONTINUOUS', 'SCROLL_RIGHT_CONTINUOUS']:
 			self.scroll_repeats = (self.txt_surf_dim.width // self.fnt_txt_surf_dim.width) + 2
 
+		# Set when the header needs to be shown again, the console is recomposed then
+		self.changed = True
+		self.shown_text = self.text
+
 	def update(self):
 		''' Called from console update function in order to generate the dynamic
 		text in the header and adjust the surface, if needed.
 		'''
 
+		# Scrolling text moves on every frame
+		if self.layout_name.startswith('SCROLL'):
+			self.changed = True
+
 		# Only do something if dynamic params are needed. Otherwise, it is not necessary
 		if self.text_params:
 			
-			# prepare the dynamic text
+			# prepare the dynamic text, the surface is only regenerated if the text changed
 			text = self.text.format(*[getattr(self.console.app, method_name)() for method_name in self.text_params])
+			if text == self.shown_text:
+				return
+			self.shown_text = text
+			self.changed = True
 
 			# generate the new text in self.text_surface object
 			(self.fnt_txt_surf, self.fnt_txt_surf_dim) = self.font_object.render(text, self.font_color, None )
@@ -544,10 +637,15 @@ class TextOutput:
 
 		''' Buffer related parameters
 		'''
-		# Stores list of past commands
-		self.buffer = []
+		# Stores past output lines as (text, color) pairs
+		self.buffer = RingBuffer(self.buffer_size)
 		# Necessary for implemetation of scrolling in the output buffer (PgUp, PgDown)
 		self.buffer_offset = 0	
+		# Rendered lines by the number of the buffer entry, see prepare_surface
+		self.line_surfaces = {}
+		# Set when the buffer or the buffer offset changes, surfaces are then prepared
+		# once per frame by refresh, however many lines were written
+		self.changed = False
 
 		''' Font and surface related params - part of prepare_surface and show functions
 			*******************************
@@ -556,12 +654,10 @@ class TextOutput:
 			- txt_surf ... surface to display text, applies padding to surface, cuts the text. It is transparent. and 
 			               it is blitted to the main surface
 			- txt_surf_dim ... dimension (Rect) of the text surface
-			- fnt_txt_surf ... surface for displaying front font text. It is being blitted to txt_surf in order to cut
-								the text so it does not cross the console borders
+			- fnt_txt_surf ... surface for displaying front font text of one line, cached in line_surfaces.
+								It is being blitted to txt_surf in order to cut the text so it does not cross the console borders
 			- fnt_txt_surf_dim ... dimension (Rect) of the front font end surface
-			- fnt_bck_surf ... surface for displaying backgound of the font text. It is being blitted to txt_surf in order to cut
-								the text so it does not cross the console borders
-			- fnt_bck_surf_dim ... dimensions (Rect) of the text background
+			- font_bck_color ... if set, the background of the font text is filled on txt_surf below the front font text
 		''' 
 
 		if not pygame.freetype.was_init(): pygame.freetype.init() 
@@ -575,46 +671,54 @@ class TextOutput:
 			self.line_spacing = rect_tmp.height
 
 		# Create the main surface and tex_surf
+		self.surf = None
+		self.txt_surf = None
+		# Numbers of the buffer entries displayed on the rows of txt_surf (None for empty rows),
+		# and the number of the entry on the first row
+		self.txt_rows = []
+		self.txt_start = 0
 		self.prepare_surface()
 
 	def prepare_surface(self):
-		''' Takes the buffer and based on the buffer offset (position) genertes output 
-		lines surfaces (self.surf_lines) and surface (self.surf). Those are used in show 
-		function to blit to the screen.
+		''' Takes the buffer and based on the buffer offset (position) composes the displayed
+		lines on the text surface (self.txt_surf) and prepares the background surface (self.surf).
+		Those are used in show function to blit to the screen.
+
+		Rendered lines are cached per buffer entry (self.line_surfaces). Rows already displayed
+		are kept - when the displayed lines move (scrolling, old lines dropped from the buffer),
+		the text surface is shifted and only the newly exposed rows are rendered.
 		'''
 
-		# First we need to clear all the buffer surfaces
-		self.surf_lines = []
+		self.changed = False
 
-		# We fill the surf_lines list with buffer lines surfaces based on buffer offset and 
-		# number of lines that we want to display
-		for i in range(self.buffer_offset, min([len(self.buffer), self.buffer_offset + self.display_lines])):
-			# Create font object with given text and given color
-			# TODO - to check if the self.prompt must be on the line below???
-			(surface_line_tmp, rect_tmp) = self.font_object.render(self.prompt + self.buffer[i][0], self.buffer[i][1], None)
-			self.surf_lines.append( (surface_line_tmp, rect_tmp) )
+		# Buffer entries are numbered in order of writing, so that the number of a line does not
+		# change when older lines are dropped from the buffer
+		first = self.buffer.total - len(self.buffer)
+		start = first + self.buffer_offset
+		lines = self.buffer.window(self.buffer_offset, self.buffer_offset + self.display_lines)
 
 		# Calculate the dimensions of test output surface
 		self.surf_dim = pygame.Rect(
 									0,
 									0,
 									self.width,
-									(self.line_spacing * len(self.surf_lines)) + self.padding.up + self.padding.down
+									(self.line_spacing * len(lines)) + self.padding.up + self.padding.down
 		)
 
-		# And create the surface from scratch again
-		self.surf = pygame.Surface((self.surf_dim.width, self.surf_dim.height))
+		# Create the background surface only when its size changes
+		if self.surf is None or self.surf.get_size() != self.surf_dim.size:
+			self.surf = pygame.Surface((self.surf_dim.width, self.surf_dim.height))
 
-		# Fill the output surface with background color
-		self.surf.fill(self.bck_color)
-		
-		# Set alpha of the header surface
-		self.surf.set_alpha(self.bck_alpha)
+			# Fill the output surface with background color
+			self.surf.fill(self.bck_color)
+
+			# Set alpha of the header surface
+			self.surf.set_alpha(self.bck_alpha)
 
-		# Create background (completely transparent)
-		# on which the text lines are blitted. The reason is to cut 
-		# the text so that it is not going over the borders.
-		# This surface's dimensions are adjusted by padding
+		# Transparent surface on which the text lines are composed. The reason is to cut 
+		# the text so that it is not going over the borders. This surface's dimensions 
+		# are adjusted by padding, it has room for all display_lines and only the rows
+		# with lines are shown.
 		self.txt_surf_dim = pygame.Rect(
 									0,
 									0,
@@ -622,50 +726,81 @@ class TextOutput:
 									self.surf_dim.height - self.padding.up - self.padding.down
 		)
 
-		self.txt_surf = pygame.Surface((self.txt_surf_dim.width, self.txt_surf_dim.height), pygame.SRCALPHA)
+		if self.txt_surf is None:
+			self.txt_surf = pygame.Surface((self.txt_surf_dim.width, self.line_spacing * self.display_lines), pygame.SRCALPHA)
+			self.txt_surf.fill((0,0,0,0)) # Last 0 indicates alpha, i.e. full transparency
+			self.txt_rows = [None] * self.display_lines
+
+		# Shift the rows which stay displayed, the exposed rows (marked -1) keep their old pixels
+		shift = start - self.txt_start
+		if shift and abs(shift) < self.display_lines:
+			self.txt_surf.scroll(0, -shift * self.line_spacing)
+			if shift > 0:
+				self.txt_rows = self.txt_rows[shift:] + [-1] * shift
+			else:
+				self.txt_rows = [-1] * -shift + self.txt_rows[:shift]
+		self.txt_start = start
 
-	def show(self, surf, pos=(0,0)):
-		''' Blits main surface, text cut surface and all individual lines to
-		the given surface.
-		'''		
-		
-		# Blit output background
-		surf.blit(self.surf, (int(pos[0]), int(pos[1])))
+		# Render the rows which changed
+		for row in range(self.display_lines):
+			number = start + row if row < len(lines) else None
+			if self.txt_rows[row] == number:
+				continue
+			self.txt_rows[row] = number
 
-		# Clear the main text input surf on which the actual text is blitted
-		self.txt_surf.fill((0,0,0,0)) # Last 0 indicates alpha, i.e. full transparency
+			row_rect = pygame.Rect(0, row * self.line_spacing, self.txt_surf_dim.width, self.line_spacing)
+			self.txt_surf.fill((0,0,0,0), row_rect)
+			if number is None:
+				continue
 
-		# Blit all the line surfaces to the txt_surface
-		height = 0
-		for i in range(len(self.surf_lines)):
-			
-			# Get the line surface from the list
-			(fnt_txt_surf, fnt_txt_surf_dim) = self.surf_lines[i]
+			# Create font object with given text and given color
+			# TODO - to check if the self.prompt must be on the line below???
+			if number not in self.line_surfaces:
+				(text_line, color) = lines[row]
+				self.line_surfaces[number] = self.font_object.render(self.prompt + text_line, color, None)
+			(fnt_txt_surf, fnt_txt_surf_dim) = self.line_surfaces[number]
 
-			# Blit font background
+			line_pos = (0, int(row_rect.y + self.line_spacing - (( self.line_spacing - fnt_txt_surf_dim.height) // 2) - fnt_txt_surf_dim.height))
+
+			# Font background
 			if self.font_bck_color:
-				fnt_bck_surf = pygame.Surface((fnt_txt_surf_dim.width, fnt_txt_surf_dim.height))
-				fnt_bck_surf.fill(self.font_bck_color)
-				
-				self.txt_surf.blit(fnt_bck_surf,
-						(0,
-						int(height + self.line_spacing - (( self.line_spacing - fnt_txt_surf_dim.height) // 2) - fnt_txt_surf_dim.height)))
+				self.txt_surf.fill(self.font_bck_color, pygame.Rect(line_pos, fnt_txt_surf_dim.size))
 
-			self.txt_surf.blit(fnt_txt_surf, 
-						(0,
-						int(height + self.line_spacing - (( self.line_spacing - fnt_txt_surf_dim.height) // 2) - fnt_txt_surf_dim.height)))
+			self.txt_surf.blit(fnt_txt_surf, line_pos)
 
-			height = height + self.line_spacing
+		# Keep rendered lines which are still in the buffer and within one page from the displayed ones
+		low, high = max(first, start - self.display_lines), start + 2 * self.display_lines
+		if len(self.line_surfaces) > 3 * self.display_lines:
+			self.line_surfaces = {number: line for number, line in self.line_surfaces.items() if low <= number < high}
+
+	def show(self, surf, pos=(0,0)):
+		''' Blits main surface and the text surface with the composed lines to
+		the given surface.
+		'''		
 		
-		# Blit text surface to surf - take account text padding
+		# Blit output background
+		surf.blit(self.surf, (int(pos[0]), int(pos[1])))
+
+		# Blit the displayed rows of the text surface to surf - take account text padding
 		surf.blit(self.txt_surf, 
 				(int(pos[0] + self.padding.left),
-				int(pos[1] + self.padding.up)))
+				int(pos[1] + self.padding.up)),
+				self.txt_surf_dim)
+
+	def refresh(self):
+		''' Runs prepare_surface if the buffer or the buffer offset changed since
+		the surfaces were prepared. Called by the Console before it is shown.
+		Returns True if the surfaces changed.
+		'''
+		if not self.changed:
+			return False
+		self.prepare_surface()
+		return True
 
 	def update(self, events):
 		''' Handles scrolling the output buffer by pressing pgUP and pgDOWN keys.
-		After pressing of those keys and also RETURN key, it is necessary to run
-		prepare_surface function in order to generate new surfaces.
+		After pressing of those keys and also RETURN key, the surfaces need to be
+		regenerated - they are marked as changed and prepared by refresh.
 		'''
 
 		for event in events:
@@ -673,27 +808,27 @@ class TextOutput:
 
 				if event.key == pl.K_PAGEUP:
 					self.buffer_offset = max([0, self.buffer_offset - self.display_lines])
-					self.prepare_surface()
+					self.changed = True
 
 				elif event.key == pl.K_PAGEDOWN:
 					self.buffer_offset = min([max([0, len(self.buffer) - self.display_lines]), self.buffer_offset + self.display_lines])
-					self.prepare_surface()
+					self.changed = True
 
 				elif event.key == pl.K_RETURN:
 					self.buffer_offset = max([0, len(self.buffer) - self.display_lines])
-					self.prepare_surface()
+					self.changed = True
 			
 			elif event.type == pygame.MOUSEBUTTONDOWN:
 
 				# On mouse roll button UP - one row up
 				if event.button == 4:
 					self.buffer_offset = max([0, self.buffer_offset - 1])
-					self.prepare_surface()
+					self.changed = True
 
 				# On mouse roll button DOWN - one row down
 				elif event.button == 5:
 					self.buffer_offset = min([max([0, len(self.buffer) - 1]), self.buffer_offset + 1])
-					self.prepare_surface()
+					self.changed = True
 
 	def write(self, text, color=None):
 		''' Handles adding output text into textoutput buffer in given color
@@ -703,6 +838,9 @@ class TextOutput:
 		# If color of the putput text is not specifically given, use predefined color
 		if not color: color = self.font_color
 
+		# Surfaces are prepared later by refresh, so that many writes cost one preparation
+		self.changed = True
+
 		# Remove newline at the end
 		text.rstrip()
 	
@@ -715,16 +853,9 @@ class TextOutput:
 				# Split text_line to the list of strings based on number of displayable characters
 				text_line_parts = [text_line[i:i+self.display_columns] for i in range(0, len(text_line), self.display_columns)]	
 
-				# Add every splitted string into the output buffer
+				# Add every splitted string into the output buffer, the oldest rows are dropped when it is full
 				for text_line_part in text_line_parts:
-					
 					self.buffer.append((text_line_part, color))
-
-					# Remove old rows from the buffer
-					if len(self.buffer) > self.buffer_size:
-						for i in range(1,len(self.buffer)):
-							self.buffer[i-1] = self.buffer[i]
-						del self.buffer[len(self.buffer)-1]
 	
 	def get_height(self):
 		''' Returns current height of the text output surface. 
@@ -813,7 +944,8 @@ class TextInput:
 
 		''' Buffer related parameters
 		'''
-		self.buffer = []
+		# Stores past commands
+		self.buffer = RingBuffer(self.buffer_size)
 		self.buffer_offset = 0
 
 		''' Font and surface related params
@@ -826,11 +958,12 @@ class TextInput:
 			- cursor_surf ... surface for displaying the blinking cursor
 			- cursor_surf_dim ... dimensions (Rect) of the cursor
 			- fnt_txt_surf ... surface for displaying front font text. It is being blitted to txt_surf in order to cut
-								the text so it does not cross the console borders
-			- fnt_txt_surf_dim ... dimension (Rect) of the front font end surface
-			- fnt_bck_surf ... surface for displaying backgound of the font text. It is being blitted to txt_surf in order to cut
-								the text so it does not cross the console borders
-			- fnt_bck_surf_dim ... dimensions (Rect) of the text background
+								the text so it does not cross the console borders. It is wider than the text,
+								so that characters can be added without creating a new surface
+			- fnt_txt_surf_dim ... dimension (Rect) of the front font end text
+			- glyphs ... rendered characters, see glyph function
+			- offsets ... x positions of the characters of prompt + text, followed by the width of the text.
+						  Cursor position is looked up here instead of measuring the text.
 		''' 
 		if not pygame.freetype.was_init(): pygame.freetype.init() 
 		self.font_object = pygame.freetype.Font(self.font_file, self.font_size)
@@ -840,6 +973,9 @@ class TextInput:
 		# characters in input_string.
 		(_, rect_tmp) = self.font_object.render('|q', self.font_color, None)
 		self.line_spacing = rect_tmp.height
+		# Characters are rendered one by one on the same baseline
+		self.baseline = rect_tmp.y
+		self.glyphs = {}
 
 		#####
 		# Create the main text input surface
@@ -869,15 +1005,8 @@ class TextInput:
 		#####
 		# Create surface for text and store its dimensions
 		#####
-		(self.fnt_txt_surf, self.fnt_txt_surf_dim) = self.font_object.render(self.prompt + self.text, self.font_color, None)
-
-		#####
-		# Create surface for text background if needed
-		#####
-		if self.font_bck_color:
-			self.fnt_bck_surf_dim = self.fnt_txt_surf_dim
-			self.fnt_bck_surf = pygame.Surface((self.fnt_bck_surf_dim.width, self.line_spacing))
-			self.fnt_bck_surf.fill(self.font_bck_color)
+		self.fnt_txt_surf = pygame.Surface((self.txt_surf_dim.width, self.line_spacing), pygame.SRCALPHA)
+		self.render_text()
 
 		#####
 		# Create surface for the cursor + additional cursor parameters
@@ -898,32 +1027,161 @@ class TextInput:
 		self.cursor_switch_ms = 500  # cursor blinks every 500ms
 		self.cursor_ms_counter = 0 
 
-		# Necessary to blit cursore surface to the correct position - TODO - do we need this?? This is same rect as for text_input but it ends at the position of the cursor
-		#( _ , self.cursor_rect) = self.font_object.render (self.prompt + self.text[:self.cursor_position], self.font_color, None) 
-		self.cursor_blit_position = self.font_object.get_rect(self.prompt + self.text[:self.cursor_position]).width
-
 		#####
-		# Scrolling parameters
-		#####		
-		# Used for continuous seemless scrolling of input text if text is longer than viewable area
-		self.fnt_txt_scroll_offset =  min(0, int(self.txt_surf_dim.width - self.fnt_txt_surf_dim.width - self.cursor_surf_dim.width))
+		# Text dimensions, cursor position and scrolling parameters - see text_changed
+		# Set changed when the text or the cursor changes, the console is recomposed then
+		#####
+		self.text_changed()
 
 	def prepare_surface(self):
-		''' After some text is entered it is necessary to regenerate
-		the text surfaces. This function is called from update method
-		where we handle text input and modification
+		''' After the whole text is replaced (e.g. from the history) it is necessary 
+		to regenerate the text surfaces. Typing only renders the edited characters, see edit function.
 		'''
-		
-		# Re-render front and back text surface
-		(self.fnt_txt_surf, self.fnt_txt_surf_dim)  = self.font_object.render(self.prompt + self.text, self.font_color, None)
+		self.render_text()
+		self.text_changed()
 
-		if self.font_bck_color:
-			self.fnt_bck_surf_dim = self.fnt_txt_surf_dim
-			self.fnt_bck_surf = pygame.Surface((self.fnt_bck_surf_dim.width, self.line_spacing))
-			self.fnt_bck_surf.fill(self.font_bck_color)
+	def glyph(self, char):
+		''' Returns the rendered character as (surface, rect, advance) tuple. Rect is the position
+		of the surface relative to the pen position on the baseline, advance is the width of the character.
+		Each character is rendered and measured only once.
+		'''
+		glyph = self.glyphs.get(char)
+		if glyph is None:
+			(glyph_surf, glyph_rect) = self.font_object.render(char, self.font_color, None)
+			metrics = self.font_object.get_metrics(char)
+			# Whole pixels, so that moved characters stay on the same pixels as rendered ones
+			advance = int(round(metrics[0][4])) if metrics and metrics[0] else glyph_rect.width
+			glyph = self.glyphs[char] = (glyph_surf, glyph_rect, advance)
+		return glyph
+
+	def render_text(self):
+		''' Measures all the characters of prompt + text and renders them on the text surface
+		'''
+		self.offsets = [0]
+		for char in self.prompt + self.text:
+			self.offsets.append(self.offsets[-1] + self.glyph(char)[2])
+		self.char_counts = Counter(self.prompt + self.text)
+		self.reserve_width()
+		self.fnt_txt_surf.fill((0,0,0,0))
+		self.draw_glyphs(0, self.offsets[-1] + self.line_spacing)
+
+	def reserve_width(self, width=0):
+		''' Makes sure that the text surface is wide enough for the text and the given width.
+		The surface is doubled when it is too narrow, so that adding characters one by one stays cheap.
+		'''
+		# Space for characters drawn behind their advance (e.g. italics)
+		needed = max(self.offsets[-1], width) + 2 * self.line_spacing
+		if needed <= self.fnt_txt_surf.get_width():
+			return
+		surf = pygame.Surface((max(needed, 2 * self.fnt_txt_surf.get_width()), self.line_spacing), pygame.SRCALPHA)
+		surf.fill((0,0,0,0))
+		# Adding to the transparent surface copies the pixels including their alpha
+		surf.blit(self.fnt_txt_surf, (0, 0), special_flags=pygame.BLEND_RGBA_ADD)
+		self.fnt_txt_surf = surf
+
+	def draw_glyphs(self, x1, x2):
+		''' Renders again the text between x positions x1 and x2. The area is cleared and
+		the characters in it are blitted, including their neighbours which may reach into it.
+		'''
+		text = self.prompt + self.text
+		area = pygame.Rect(x1, 0, x2 - x1, self.line_spacing)
+		self.fnt_txt_surf.fill((0,0,0,0), area)
+		self.fnt_txt_surf.set_clip(area)
+		first = max(bisect_right(self.offsets, x1) - 2, 0)
+		last = min(bisect_left(self.offsets, x2) + 1, len(text))
+		for index in range(first, last):
+			(glyph_surf, glyph_rect, _) = self.glyph(text[index])
+			self.fnt_txt_surf.blit(glyph_surf, (self.offsets[index] + glyph_rect.x, self.baseline - glyph_rect.y))
+		self.fnt_txt_surf.set_clip(None)
+
+	def edit(self, start, stop, string=''):
+		''' Replaces the characters start:stop of the text by the string. Only the new characters
+		are measured and rendered, the rest of the text is moved on the text surface.
+		'''
+		first, last = len(self.prompt) + start, len(self.prompt) + stop
+		old_width = self.offsets[-1]
+		old_stop = self.offsets[last]
+
+		# Positions behind the edit are shifted by the difference of widths
+		new_offsets = []
+		x = self.offsets[first]
+		for char in string:
+			x += self.glyph(char)[2]
+			new_offsets.append(x)
+		shift = x - old_stop
+		self.offsets[first + 1:] = new_offsets + [offset + shift for offset in self.offsets[last + 1:]]
+		self.char_counts -= Counter(self.text[start:stop])
+		self.char_counts += Counter(string)
+		self.text = self.text[:start] + string + self.text[stop:]
+		self.reserve_width(old_width)
+
+		# Move the rendered text behind the edit
+		if shift and old_width > old_stop:
+			left = min(old_stop, old_stop + shift)
+			self.fnt_txt_surf.set_clip(pygame.Rect(left, 0, max(old_width, self.offsets[-1]) + self.line_spacing - left, self.line_spacing))
+			self.fnt_txt_surf.scroll(shift, 0)
+			self.fnt_txt_surf.set_clip(None)
+
+		# Render the edited characters and their neighbours
+		end = first + len(string) + 1
+		x2 = self.offsets[end] if end < len(self.offsets) else self.offsets[-1] + self.line_spacing
+		self.draw_glyphs(self.offsets[max(first - 1, 0)], x2)
+
+		# Clear what is left behind the end of a shorter text
+		if shift < 0:
+			self.draw_glyphs(self.offsets[-1], old_width + self.line_spacing)
+		self.text_changed()
+
+	def text_rect(self):
+		''' Returns the rect of the ink of prompt + text, as font_object.get_rect would: x is the left edge
+		relative to the pen position, y the top edge above the baseline. It is found from the rendered
+		characters - the distinct ones for the height and the ones near both ends for the width.
+		'''
+		text = self.prompt + self.text
+		if not text:
+			return self.font_object.get_rect('')
+		rects = [self.glyph(char)[1] for char in self.char_counts]
+		top = max(rect.y for rect in rects)
+		bottom = min(rect.y - rect.height for rect in rects)
+		bearing = min(rect.x for rect in rects)
+		reach = max(rect.x + rect.width for rect in rects)
+
+		# Scan from both ends until no character further in can reach beyond the edge
+		left = right = None
+		for index in range(len(text)):
+			if left is not None and self.offsets[index] + bearing >= left:
+				break
+			rect = self.glyph(text[index])[1]
+			left = self.offsets[index] + rect.x if left is None else min(left, self.offsets[index] + rect.x)
+		for index in range(len(text) - 1, -1, -1):
+			if right is not None and self.offsets[index] + reach <= right:
+				break
+			rect = self.glyph(text[index])[1]
+			right = self.offsets[index] + rect.right if right is None else max(right, self.offsets[index] + rect.right)
+		return pygame.Rect(left, top, right - left, top - bottom)
+
+	def text_changed(self):
+		''' Updates the text dimensions, scrolling and cursor after the text is modified
+		'''
+		# The text is placed as the text rendered at once was: its ink starts at the scroll offset
+		# and is centered vertically on the line
+		self.fnt_txt_rect = self.text_rect()
+		self.fnt_txt_surf_dim = pygame.Rect(0, 0, self.fnt_txt_rect.width, self.line_spacing)
+		self.fnt_txt_top = self.line_spacing - ((self.line_spacing - self.fnt_txt_rect.height) // 2) - self.fnt_txt_rect.height
+
+		# Necessary to blit cursor surface to the correct position - x position of the character at the cursor
+		self.cursor_position = min(self.cursor_position, len(self.text))
+		self.cursor_blit_position = self.offsets[len(self.prompt) + self.cursor_position]
 
-		# Update scroll offset after input text is somehow modified
+		# Used for continuous seemless scrolling of input text if text is longer than viewable area
 		self.fnt_txt_scroll_offset =  min(0, int(self.txt_surf_dim.width - self.fnt_txt_surf_dim.width - self.cursor_surf_dim.width))
+		self.changed = True
+
+	def move_cursor(self, position):
+		''' Moves the cursor to the given position in the text, but not outside of the text
+		'''
+		self.cursor_position = max(0, min(position, len(self.text)))
+		self.cursor_blit_position = self.offsets[len(self.prompt) + self.cursor_position]
 
 	def update(self, events):
 		''' Handles pressing of the keys. After the press, it is necessary to run
@@ -938,66 +1196,46 @@ class TextInput:
 				
 				# If key is pressed, cursor must be ALWAYS visible so that person knows where to edit
 				self.cursor_visible = True
+				self.changed = True
 
 				# If none exist, create counter for that key:
 				if event.key not in self.keyrepeat_counters:
 					self.keyrepeat_counters[event.key] = [0, event.unicode]
 
 				if event.key == pl.K_BACKSPACE:
-					self.text = (
-						self.text[:max(self.cursor_position - 1, 0)]
-						+ self.text[self.cursor_position:]
-					)
-					# Subtract one from cursor_pos, but do not go below zero:
-					self.cursor_position = max(self.cursor_position - 1, 0)
-					self.cursor_blit_position = self.font_object.get_rect(self.prompt + self.text[:self.cursor_position]).width
-
-					# Regenerate text surfaces
-					self.prepare_surface()
+					# Only if there is something in front of the cursor
+					if self.cursor_position > 0:
+						self.cursor_position -= 1
+						self.edit(self.cursor_position, self.cursor_position + 1)
 
 				elif event.key == pl.K_DELETE:
-					self.text = (
-						self.text[:self.cursor_position]
-						+ self.text[self.cursor_position + 1:]
-					)
-					# Regenerate text surfaces
-					self.prepare_surface()
+					if self.cursor_position < len(self.text):
+						self.edit(self.cursor_position, self.cursor_position + 1)
 
 				elif event.key == pl.K_RETURN:
 					# Only store if there is something to store
 					if self.text:
+						# The oldest command is dropped when the buffer is full
 						self.buffer.append(self.text)
+						# Point behind the last command, so that UP restores it
 						self.buffer_offset = len(self.buffer)
 
-						# Remove old rows from the buffer
-						if len(self.buffer) > self.buffer_size:
-							for i in range(1,len(self.buffer)):
-								self.buffer[i-1] = self.buffer[i]
-							del self.buffer[len(self.buffer)-1]
-							# Adjust the buffer offset to point to the last item in the list
-							self.buffer_offset = len(self.buffer) - 1
-
 					# Important to return True so that console instance knows that it must process a command
 					return True
 
 				elif event.key == pl.K_RIGHT:
 					# Add one to cursor_pos, but do not exceed len(input_string)
-					self.cursor_position = min(self.cursor_position + 1, len(self.text))
-					self.cursor_blit_position = self.font_object.get_rect(self.prompt + self.text[:self.cursor_position]).width
+					self.move_cursor(self.cursor_position + 1)
 
 				elif event.key == pl.K_LEFT:
 					# Subtract one from cursor_pos, but do not go below zero:
-					self.cursor_position = max(self.cursor_position - 1, 0)
-					self.cursor_blit_position = self.font_object.get_rect(self.prompt + self.text[:self.cursor_position]).width
-
+					self.move_cursor(self.cursor_position - 1)
 
 				elif event.key == pl.K_END:
-					self.cursor_position = len(self.text)
-					self.cursor_blit_position = self.font_object.get_rect(self.prompt + self.text[:self.cursor_position]).width
+					self.move_cursor(len(self.text))
 
 				elif event.key == pl.K_HOME:
-					self.cursor_position = 0
-					self.cursor_blit_position = self.font_object.get_rect(self.prompt + self.text[:self.cursor_position]).width
+					self.move_cursor(0)
 
 				# Scroll the buffer - to the history
 				elif event.key == pl.K_UP:
@@ -1007,12 +1245,9 @@ class TextInput:
 						if self.buffer_offset >= 1: self.buffer_offset = self.buffer_offset - 1
 						# Restore previous input string - last in buffer
 						self.text = self.buffer[self.buffer_offset]						
-						# Set cursor possition at the end of the string
-						self.cursor_position = len(self.text)
-						self.cursor_blit_position = self.font_object.get_rect(self.prompt + self.text[:self.cursor_position]).width
-
-						# Regenerate text surfaces
+						# Regenerate text surfaces and set cursor possition at the end of the string
 						self.prepare_surface()
+						self.move_cursor(len(self.text))
 
 				# Scroll the buffer - to the future
 				elif event.key == pl.K_DOWN:
@@ -1021,26 +1256,15 @@ class TextInput:
 						self.buffer_offset = self.buffer_offset + 1
 						# Restore previous input string - last in buffer
 						self.text = self.buffer[self.buffer_offset]
-						# Set cursor possition at the end of the string
-						self.cursor_position = len(self.text)
-						self.cursor_blit_position = self.font_object.get_rect(self.prompt + self.text[:self.cursor_position]).width
-
-						# Regenerate text surfaces
+						# Regenerate text surfaces and set cursor possition at the end of the string
 						self.prepare_surface()
+						self.move_cursor(len(self.text))
 		
 				# Only add new characters if the max limit is not overreached
-				elif len(self.text) < self.max_input_text:					
+				elif len(self.text) < self.max_input_text and event.unicode:
 					# If no special key is pressed, add unicode of key to input_string
-					self.text = (
-						self.text[:self.cursor_position]
-						+ event.unicode
-						+ self.text[self.cursor_position:]
-					)
-					self.cursor_position += len(event.unicode)  # Some are empty, e.g. K_UP
-					self.cursor_blit_position = self.font_object.get_rect(self.prompt + self.text[:self.cursor_position]).width
-
-					# Regenerate text surfaces
-					self.prepare_surface()
+					self.edit(self.cursor_position, self.cursor_position, event.unicode)
+					self.move_cursor(self.cursor_position + len(event.unicode))
 
 			elif event.type == pl.KEYUP:
 				# *** Because KEYUP doesn't include event.unicode, this dict is stored in such a weird way
@@ -1072,6 +1296,7 @@ class TextInput:
 		if self.cursor_ms_counter >= self.cursor_switch_ms:
 			self.cursor_ms_counter %= self.cursor_switch_ms
 			self.cursor_visible = not self.cursor_visible
+			self.changed = True
 				
 		# TODO - revise - use console clock - clock must tick in order to see blinking cursor!
 		self.clock.tick()
@@ -1092,14 +1317,13 @@ class TextInput:
 
 		# Input text background blit
 		if self.font_bck_color:			
-			self.txt_surf.blit(self.fnt_bck_surf,
-					(int(self.fnt_txt_scroll_offset),
-					int(self.line_spacing - ((self.line_spacing - self.fnt_bck_surf_dim.height) // 2) - self.fnt_bck_surf_dim.height)))
+			# Clipped first, fill would move a rect reaching left of the surface instead of cutting it
+			self.txt_surf.fill(self.font_bck_color, self.fnt_txt_surf_dim.move(int(self.fnt_txt_scroll_offset), self.fnt_txt_top).clip(self.txt_surf.get_rect()))
 
-		# Input text blit
+		# Input text blit - the text surface is clipped to the visible part, its glyphs are drawn from the pen position
 		self.txt_surf.blit(self.fnt_txt_surf,
-						(int(self.fnt_txt_scroll_offset),
-						int(self.line_spacing - ((self.line_spacing - self.fnt_txt_surf_dim.height) // 2) - self.fnt_txt_surf_dim.height)))
+						(int(self.fnt_txt_scroll_offset) - self.fnt_txt_rect.x,
+						self.fnt_txt_top + self.fnt_txt_rect.y - self.baseline))
 
 		# Cursor blit
 		if self.cursor_visible:
@@ -1130,9 +1354,32 @@ class TextInput:
 		'''
 		self.text = ''
 		self.cursor_position = 0		
-		self.cursor_blit_position = self.font_object.get_rect(self.prompt + self.text[:self.cursor_position]).width
 		self.prepare_surface()
 
+class PremultipliedLayers:
+	''' Surface-like target for the show methods of console parts. Blitted surfaces are
+	composed into one surface with premultiplied alpha (self.surf), which is then shown with
+	a single blit using special_flags=pygame.BLEND_PREMULTIPLIED. The result is the same as
+	blitting all the surfaces one after another, including their transparency.
+	'''
+
+	def __init__(self, size):
+		''' :param size: Size of the composed surface
+		'''
+		self.surf = pygame.Surface(size, pygame.SRCALPHA)
+		self.surf.fill((0,0,0,0))
+
+	def blit(self, source, dest, area=None, special_flags=0):
+		''' Composes a surface over the already blitted ones, see pygame.Surface.blit
+		'''
+		# Surface transparency is moved into the per pixel alpha, which is then premultiplied
+		alpha = source.get_alpha()
+		layer = source.convert_alpha()
+		if alpha is not None and alpha < 255:
+			layer.fill((255,255,255,alpha), special_flags=pygame.BLEND_RGBA_MULT)
+			layer.set_alpha(255)
+		self.surf.blit(layer.premul_alpha(), dest, area, special_flags=pygame.BLEND_PREMULTIPLIED)
+
 class Console(pygame.Surface):
 	''' Class implementing the game console. Console is compraised by other 
 	objects header, footer, input and output objects. If component is present
@@ -1237,6 +1484,13 @@ class Console(pygame.Surface):
 		# Set Console transparency
 		self.set_alpha(self.bck_alpha)
 
+		# Console background does not change, so it is prepared only once
+		self.fill(self.bck_color)
+		if self.bck_image: self.blit(self.bck_image, (0, 0))
+
+		# Console with all its parts, recomposed only when a part changes - see compose
+		self.composed = None
+
 		# Put the initial text on the console in given color
 		if self.console_output: self.write(self.welcome_msg, self.welcome_msg_color)
 
@@ -1257,6 +1511,12 @@ class Console(pygame.Surface):
 		# By default console is disabled
 		self.enabled = False
 
+		# Optional callback called with every entered command line before it is processed
+		self.on_command = None
+
+		# Number of nested batch() blocks in progress
+		self.batch_depth = 0
+
 	def update(self, events):
 		''' Call updates of relevant console parts. If ENTER was pressed, process the command.
 		Only process if console is enabled.
@@ -1271,8 +1531,10 @@ class Console(pygame.Surface):
 				# Put it into the textoutput - if output is defined
 				if self.console_output: self.console_output.write(self.console_input.get_text(), self.console_input.font_color)
 
-				# Process the entered line by CLI instance
-				self.cli.onecmd(self.console_input.get_text())
+				# Process the entered line by CLI instance, its output is shown at once
+				if self.on_command: self.on_command(self.console_input.get_text())
+				with self.batch():
+					self.cli.onecmd(self.console_input.get_text())
 				
 				# Reset the text, so that new one can be entered
 				self.console_input.clear_text()
@@ -1362,79 +1624,95 @@ class Console(pygame.Surface):
 		# This happens when console is either enabled or disabled and is being hidden
 		if self.anim_perc > 0:
 
-			#####
-			# Prepare the individual console components coordinates based on the layout. More layouts can be added here.
-			#####
+			# Prepare the output written since the last frame, unless a batch is in progress
+			output_changed = self.console_output.refresh() if self.console_output and not self.batch_depth else False
 
-			# Calculate position of layout items on the console based on the layout	must be done here as the console output height is changing
-			# based on lines displayed on the output.
-			if self.layout == 'INPUT_BOTTOM':
-				self.header_position = (self.padding.left, self.padding.up)
-				self.text_output_position = (self.padding.left, self.header_position[1] + (self.console_header.get_height() if self.console_header else 0))
-				self.text_input_position = (self.padding.left, self.text_output_position[1] + (self.console_output.get_height() if self.console_output else 0))
-				self.footer_position = (self.padding.left, self.dim[1] - self.padding.down - (self.console_footer.get_height() if self.console_footer else 0))		
+			# Recompose the console only if some of its parts changed, the animation only moves it
+			if (self.composed is None or output_changed
+					or (self.console_input and self.console_input.changed)
+					or (self.console_header and self.console_header.changed)
+					or (self.console_footer and self.console_footer.changed)):
+				self.compose()
 
-			if self.layout == 'INPUT_TOP':
-				self.header_position = (self.padding.left, self.padding.up)
-				self.text_input_position = (self.padding.left, self.header_position[1] + (self.console_header.get_height() if self.console_header else 0))
-				self.text_output_position = (self.padding.left, self.text_input_position[1] + (self.console_input.get_height() if self.console_input else 0))
-				self.footer_position = (self.padding.left, self.dim[1] - self.padding.down - (self.console_footer.get_height() if self.console_footer else 0))		
+			# Blit the composed console with the corrections
+			surf.blit(self.composed, (int(pos[0] + anim_dx), int(pos[1] + anim_dy)), special_flags=pygame.BLEND_PREMULTIPLIED)
 
-			#####
-			# Blit everything with the corrections
-			#####
+	def compose(self):
+		''' Blits the console background, header, output, input and footer onto 
+		the composed console surface (self.composed), which is then shown by a single blit.
+		'''
 
-			# Clear Console background surface		
-			self.fill(self.bck_color)
-
-			# If background image is defined, paste it to console surface
-			if self.bck_image: self.blit(self.bck_image, (0, 0))
-
-			# Blit console background to the surface
-			surf.blit(self, (int(pos[0] + anim_dx), int(pos[1] + anim_dy)))
-
-			# Blit header onto the surface - by calling show and not blitting directly enables
-			# transparent background and non transparent text displayed on it.
-			if self.console_header:
-				self.console_header.show(
-					surf,
-					(int(pos[0] + anim_dx + self.header_position[0]),
-					int(pos[1] + anim_dy + self.header_position[1]))
-					)
-
-			# Blit output onto the surface
-			# Based on parameter text_input_position either on top or at the bottom of the console
-			if self.console_output:
-				self.console_output.show(
-					surf,
-					(int(pos[0] + anim_dx + self.text_output_position[0]),
-					int(pos[1] + anim_dy + self.text_output_position[1]))
-					)
-			
-			# Blit input surface onto the surface
-			# Based on parameter text_input_position either on top or at the bottom of the console
-			if self.console_input:
-				self.console_input.show(
-					surf,
-					(int(pos[0] + anim_dx + self.text_input_position[0]),
-					int(pos[1] + anim_dy + self.text_input_position[1]))
-					)		
-
-			# Blit footer onto the surface
-			if self.console_footer:
-				self.console_footer.show(
-					surf,
-					(int(pos[0] + anim_dx + self.footer_position[0]),
-					int(pos[1] + anim_dy + self.footer_position[1]))
-					)
+		#####
+		# Prepare the individual console components coordinates based on the layout. More layouts can be added here.
+		#####
+
+		# Calculate position of layout items on the console based on the layout	must be done here as the console output height is changing
+		# based on lines displayed on the output.
+		if self.layout == 'INPUT_BOTTOM':
+			self.header_position = (self.padding.left, self.padding.up)
+			self.text_output_position = (self.padding.left, self.header_position[1] + (self.console_header.get_height() if self.console_header else 0))
+			self.text_input_position = (self.padding.left, self.text_output_position[1] + (self.console_output.get_height() if self.console_output else 0))
+			self.footer_position = (self.padding.left, self.dim[1] - self.padding.down - (self.console_footer.get_height() if self.console_footer else 0))		
+
+		if self.layout == 'INPUT_TOP':
+			self.header_position = (self.padding.left, self.padding.up)
+			self.text_input_position = (self.padding.left, self.header_position[1] + (self.console_header.get_height() if self.console_header else 0))
+			self.text_output_position = (self.padding.left, self.text_input_position[1] + (self.console_input.get_height() if self.console_input else 0))
+			self.footer_position = (self.padding.left, self.dim[1] - self.padding.down - (self.console_footer.get_height() if self.console_footer else 0))		
+
+		#####
+		# Blit everything onto the composed surface
+		#####
+		layers = PremultipliedLayers(self.dim)
+
+		# Blit console background
+		layers.blit(self, (0, 0))
+
+		# Blit header - by calling show and not blitting directly enables
+		# transparent background and non transparent text displayed on it.
+		if self.console_header:
+			self.console_header.show(layers, self.header_position)
+			self.console_header.changed = False
+
+		# Blit output
+		# Based on parameter text_input_position either on top or at the bottom of the console
+		if self.console_output:
+			self.console_output.show(layers, self.text_output_position)
+
+		# Blit input
+		# Based on parameter text_input_position either on top or at the bottom of the console
+		if self.console_input:
+			self.console_input.show(layers, self.text_input_position)
+			self.console_input.changed = False
+
+		# Blit footer
+		if self.console_footer:
+			self.console_footer.show(layers, self.footer_position)
+			self.console_footer.changed = False
+
+		self.composed = layers.surf
 	
 	def write(self, text, color=None):
-		''' Put some text onto a console by calling this function
+		''' Put some text onto a console by calling this function. The text is shown
+		on the next frame - writes within one frame are coalesced into one redraw of the output.
 		'''
 		self.console_output.write(text, color)
 
-		# Without calling prepare_surface the text will not be shown immediatelly
-		self.console_output.prepare_surface()
+	@contextmanager
+	def batch(self):
+		''' Context for bulk output, e.g. a long script or a large dump. The output
+		written within the block is shown on the first frame after the block ends, even
+		if frames are displayed meanwhile. Batches can be nested.
+
+		e.g.
+			with console.batch():
+				for line in lines: console.write(line)
+		'''
+		self.batch_depth += 1
+		try:
+			yield self
+		finally:
+			self.batch_depth -= 1
 
 	def toggle(self):
 		''' Toggle on/off the console. Influences if updade and show console functions are 
@@ -1454,8 +1732,9 @@ class Console(pygame.Surface):
 	def clear(self):
 		''' Method that clears the output on the screen
 		'''
-		self.console_output.log = list()
-		self.console_output.prepare_surface()
+		self.console_output.buffer.clear()
+		self.console_output.buffer_offset = 0
+		self.console_output.changed = True
 
 '''
 	Example of the use of the Console
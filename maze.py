@@ -0,0 +1,214 @@
+"""
+This file contains maze generation algorithms used by the MazeGenerator,
+and a union-find based solvability check.
+
+Mazes are boolean wall arrays of shape (width, height), indexed [x, y].
+Maze cells lie on even (x, y) offsets and are all connected, every other
+square is a wall or a passage between two neighboring cells.
+"""
+
+import numpy as np
+
+
+class UnionFind:
+    """
+    Disjoint sets of integers 0..n-1, with union by size and path halving
+    """
+    def __init__(self, n):
+        """
+        :param n: Number of elements
+        """
+        self.parent = list(range(n))
+        self.size = [1] * n
+
+    def find(self, a):
+        """
+        Returns the representative of the set of an element
+        :param a: The element
+        :return: Representative element
+        """
+        parent = self.parent
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+
+    def union(self, a, b):
+        """
+        Joins the sets of two elements
+        :param a: First element
+        :param b: Second element
+        :return: True if the elements were in different sets, False otherwise
+        """
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return False
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+        return True
+
+
+def _cells(shape):
+    """
+    Returns the size of the cell lattice of a maze, and the maze with all cells open
+    :param shape: (width, height) of the maze in squares
+    :return: A (columns, rows, walls) tuple
+    """
+    walls = np.ones(shape, dtype=bool)
+    walls[0::2, 0::2] = False
+    return (shape[0] + 1) // 2, (shape[1] + 1) // 2, walls
+
+
+def _neighbors(i, j, columns, rows):
+    """
+    Returns the cells adjacent to a cell
+    :param i: Column of the cell
+    :param j: Row of the cell
+    :param columns: Number of columns of cells
+    :param rows: Number of rows of cells
+    :return: A list of (i, j) cells
+    """
+    return [(a, b) for a, b in ((i + 1, j), (i - 1, j), (i, j + 1), (i, j - 1))
+            if 0 <= a < columns and 0 <= b < rows]
+
+
+def backtracker(shape, rng):
+    """
+    Generates a maze with the recursive backtracker (randomized depth-first search).
+    Runs in linear time, produces long winding corridors.
+    :param shape: (width, height) of the maze in squares
+    :param rng: numpy.random.Generator
+    :return: Boolean wall array
+    """
+    columns, rows, walls = _cells(shape)
+    if not columns or not rows:
+        return walls
+    visited = [[False] * rows for _ in range(columns)]
+    # Each cell is entered once and left once, so 2 numbers per cell suffice
+    choices = iter(rng.random(2 * columns * rows).tolist())
+
+    start = (int(rng.integers(columns)), int(rng.integers(rows)))
+    visited[start[0]][start[1]] = True
+    stack = [start]
+    while stack:
+        i, j = stack[-1]
+        options = [(a, b) for a, b in _neighbors(i, j, columns, rows) if not visited[a][b]]
+        if not options:
+            stack.pop()
+            continue
+        a, b = options[int(next(choices) * len(options))]
+        visited[a][b] = True
+        walls[i + a, j + b] = False
+        stack.append((a, b))
+    return walls
+
+
+def kruskal(shape, rng):
+    """
+    Generates a maze with the randomized Kruskal's algorithm: walls between cells are
+    removed in random order, unless the cells are already connected.
+    Runs in almost linear time, produces many short dead ends.
+    :param shape: (width, height) of the maze in squares
+    :param rng: numpy.random.Generator
+    :return: Boolean wall array
+    """
+    columns, rows, walls = _cells(shape)
+    if not columns or not rows:
+        return walls
+    # Passage squares between horizontally and vertically adjacent cells
+    xs, ys = np.meshgrid(np.arange(columns - 1) * 2 + 1, np.arange(rows) * 2, indexing='ij')
+    vx, vy = np.meshgrid(np.arange(columns) * 2, np.arange(rows - 1) * 2 + 1, indexing='ij')
+    px = np.concatenate((xs.ravel(), vx.ravel()))
+    py = np.concatenate((ys.ravel(), vy.ravel()))
+    order = rng.permutation(len(px))
+
+    sets = UnionFind(columns * rows)
+    for x, y in zip(px[order].tolist(), py[order].tolist()):
+        # Cells on both sides of the passage, numbered i * rows + j
+        a = (x // 2) * rows + y // 2
+        b = ((x + 1) // 2) * rows + (y + 1) // 2
+        if sets.union(a, b):
+            walls[x, y] = False
+    return walls
+
+
+def wilson(shape, rng):
+    """
+    Generates a maze with Wilson's algorithm (loop-erased random walks), which picks
+    every possible maze with the same probability
+    :param shape: (width, height) of the maze in squares
+    :param rng: numpy.random.Generator
+    :return: Boolean wall array
+    """
+    columns, rows, walls = _cells(shape)
+    if not columns or not rows:
+        return walls
+    in_maze = [[False] * rows for _ in range(columns)]
+    root = (int(rng.integers(columns)), int(rng.integers(rows)))
+    in_maze[root[0]][root[1]] = True
+
+    randoms = []
+    for start in rng.permutation(columns * rows).tolist():
+        i, j = divmod(start, rows)
+        if in_maze[i][j]:
+            continue
+        # Random walk until the maze is hit, keeping only the last exit of each cell
+        exits = {}
+        cell = (i, j)
+        while not in_maze[cell[0]][cell[1]]:
+            options = _neighbors(cell[0], cell[1], columns, rows)
+            if not randoms:
+                randoms = rng.random(4096).tolist()
+            nxt = options[int(randoms.pop() * len(options))]
+            exits[cell] = nxt
+            cell = nxt
+        # Adds the loop-erased walk to the maze
+        cell = (i, j)
+        while not in_maze[cell[0]][cell[1]]:
+            nxt = exits[cell]
+            in_maze[cell[0]][cell[1]] = True
+            walls[cell[0] + nxt[0], cell[1] + nxt[1]] = False
+            cell = nxt
+    return walls
+
+
+def random_walls(shape, rng, density):
+    """
+    Places walls at random, the maze may not be solvable
+    :param shape: (width, height) of the maze in squares
+    :param rng: numpy.random.Generator
+    :param density: Probability of a wall on each square
+    :return: Boolean wall array
+    """
+    return rng.random(shape) < density
+
+
+# Name -> maze generation algorithm, see MazeGenerator.algorithm
+ALGORITHMS = {
+    'backtracker': backtracker,
+    'kruskal': kruskal,
+    'wilson': wilson
+}
+
+
+def solvable(walls, start, end):
+    """
+    Checks if two squares of a maze are connected, using union-find over open squares
+    :param walls: Boolean wall array of shape (width, height)
+    :param start: (x, y) offset of the first square
+    :param end: (x, y) offset of the second square
+    :return: True if a path between the squares exists, False otherwise
+    """
+    walls = np.asarray(walls, dtype=bool)
+    width, height = walls.shape
+    if walls[tuple(start)] or walls[tuple(end)]:
+        return False
+    sets = UnionFind(width * height)
+    open_ = ~walls
+    for xs, ys, dx, dy in ((*np.nonzero(open_[:-1, :] & open_[1:, :]), 1, 0),
+                           (*np.nonzero(open_[:, :-1] & open_[:, 1:]), 0, 1)):
+        for x, y in zip(xs.tolist(), ys.tolist()):
+            sets.union(x * height + y, (x + dx) * height + y + dy)
+    return sets.find(start[0] * height + start[1]) == sets.find(end[0] * height + end[1])
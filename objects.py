@@ -1,37 +1,157 @@
 """
 This file contains definitions of all objects used in the game
 """
-from random import random
+from copy import copy
+import numpy as np
 import pygame.event
 from constants import *
-from grid import Grid
+import maze
+import pathfinding
+from grid import Grid, create_grid
+from config import GRID_CONFIG
 
 
-grid = Grid(30, 30)
+grid = create_grid(**GRID_CONFIG)
 
 
-class Object:
+def use_grid(new_grid):
     """
-    This class contains methods characteristic for every object
+    Makes a grid the one manipulated by all objects and by the Game.
+    Objects of other grids must not be used until their grid is restored.
+    :param new_grid: The grid
+    :return: The previously used grid
     """
-    def __init__(self):
-        self.id = grid.id_counter  # A unique id for each object
+    global grid
+    previous, grid = grid, new_grid
+    return previous
+
+
+class Hackable:
+    """
+    Marks a field declared by an object class as hackable, i.e. changeable by the player
+    with the hack command of the console, e.g. 'color': Hackable(Colors.WHITE)
+    """
+    __slots__ = ('default',)
+
+    def __init__(self, default):
+        """
+        :param default: Default value of the field
+        """
+        self.default = default
+
+
+class Schema(type):
+    """
+    Metaclass which turns the fields declared by an object class into its __slots__.
+    The merged fields of a class and its bases are available as cls.schema, and the names
+    of the hackable ones (see Hackable) as cls.hackable
+    """
+    def __new__(mcs, name, bases, namespace):
+        inherited = {}
+        hackable = set()
+        for base in reversed(bases):
+            inherited.update(getattr(base, 'schema', {}))
+            hackable.update(getattr(base, 'hackable', ()))
+        fields = namespace.get('fields', {})
+        # A field declared again is hackable only if it is marked again
+        hackable.difference_update(fields)
+        hackable.update(key for key, val in fields.items() if isinstance(val, Hackable))
+        fields = {key: val.default if isinstance(val, Hackable) else val for key, val in fields.items()}
+        namespace['__slots__'] = tuple(key for key in fields if key not in inherited)
+        namespace['schema'] = {**inherited, **fields}
+        namespace['hackable'] = frozenset(hackable)
+        # Fields with mutable defaults get a copy of the default on each instance
+        namespace['mutable_fields'] = frozenset(key for key, val in namespace['schema'].items()
+                                                if isinstance(val, (list, set, dict)))
+        return super().__new__(mcs, name, bases, namespace)
+
+
+class Object(metaclass=Schema):
+    """
+    This class contains methods characteristic for every object.
+    Attributes of objects are declared with their default values in the fields
+    dict of each class. Fields which the player can hack are marked with Hackable.
+    """
+    # Default instances of flyweight classes can be shared between squares (see Grid.instantiate)
+    flyweight = False
+    # Number of shared instances created so far
+    shared_count = 0
+    fields = {
+        'id': None,  # A unique id for each object
+        'interned': False,  # True for the shared instance of a flyweight class, which must not be changed
+        'name': None,
+        'type': Type.STATIC,
+        'symbol': '?',
+        'color': Colors.WHITE,
+        'passable_for': [],
+        'coords': (None, None),
+        'stacked': None,
+        'replacable': False
+    }
+
+    def __init__(self, **kwargs):
+        object.__setattr__(self, 'interned', False)
+        for key, val in self.schema.items():
+            setattr(self, key, copy(val) if key in self.mutable_fields else val)
+        self.id = grid.id_counter
         grid.id_counter += 1
-        self.coords = (None, None)
-        self.stacked = None
-        self.replacable = False
-        self.hackable = []
-        self.name = None
+        self.set(**kwargs)
+
+    def __setattr__(self, key, value):
+        if self.interned:
+            raise AttributeError(f"'{self.name}' is shared between squares, use Grid.writable() to change it")
+        if key in Grid.WATCHED_KEYS:
+            grid.changed(self, key, value)
+        super().__setattr__(key, value)
+
+    @classmethod
+    def restore(cls, **kwargs):
+        """
+        Creates an object from saved field values, without the side effects of the
+        class constructor (e.g. a MazeGenerator drawing its maze)
+        :param kwargs: Field values
+        :return: The object
+        """
+        obj = cls.__new__(cls)
+        Object.__init__(obj, **kwargs)
+        return obj
+
+    @classmethod
+    def shared(cls):
+        """
+        Returns the default instance of the class shared by all squares.
+        Shared instances are used by all grids, so they get negative ids, which
+        never collide with ids of objects counted by a grid.
+        :return: The shared instance
+        """
+        instance = cls.__dict__.get('_shared')
+        if instance is None:
+            instance = cls()
+            Object.shared_count += 1
+            instance.id = -Object.shared_count
+            instance.interned = True
+            cls._shared = instance
+        return instance
 
     def set(self, **kwargs):
         """
         Sets given atributes to given values
         :param kwargs: Attribute=value pairs
         :return: None
+        :raises AttributeError: If an attribute is not a field of the object
         """
         for arg, val in kwargs.items():
+            if arg not in self.schema:
+                raise AttributeError(f"{type(self).__name__} has no field '{arg}'")
             setattr(self, arg, val)
 
+    def info(self):
+        """
+        Returns values of all fields of the object
+        :return: A dict of field: value pairs, in order of declaration
+        """
+        return {key: getattr(self, key) for key in self.schema if key != 'interned'}
+
     def behavior(self, key):
         """
         This function is executed each game tick for each dynamic object
@@ -44,7 +164,7 @@ class Object:
         Returns coordinates of the object
         :return: (x, y) coordinates of the object
         """
-        return grid.find(id=self.id)
+        return grid.locate(self.id)
 
     def get_adjacent(self):
         """
@@ -72,6 +192,15 @@ class Object:
             return grid.move(self.coords, direction)
         return False
 
+    def passable_by(self, name, keys=()):
+        """
+        Checks if a moving object can enter the square of this object
+        :param name: Name of the moving object
+        :param keys: (name, color) pairs of items carried by the moving object
+        :return: True if the object can enter, False otherwise
+        """
+        return self.passable_for == 'all' or name in self.passable_for
+
     def has(self, item):
         """
         Checks if an item is in the object's inventory
@@ -92,47 +221,45 @@ class Item(Object):
     """
     This class defines methods for pickable items
     """
-    def __init__(self, **kwargs):
-        super().__init__()
-        super().set(**kwargs)
 
     def on_collision_with(self, collider):
         if collider.name == "player":
             if grid.get_player().push_inventory(self):
-                grid.place_object_f(self.get_coords(), Empty())
+                grid.place_object_f(self.get_coords(), Empty)
 
 
 class Empty(Object):
     """
     Idle object passable for everything
     """
-    def __init__(self, **kwargs):
-        super().__init__()
-        self.name = 'empty'
-        self.type = Type.STATIC
-        self.passable_for = 'all'
-        self.symbol = " "
-        self.color = (255, 255, 255)
-        self.replacable = True
-        super().set(**kwargs)
+    flyweight = True
+    fields = {
+        'name': 'empty',
+        'type': Type.STATIC,
+        'passable_for': 'all',
+        'symbol': " ",
+        'color': (255, 255, 255),
+        'replacable': True
+    }
 
 
 class Player(Object):
     """
     The object which is controlled by the player
     """
+    fields = {
+        'name': 'player',
+        'type': Type.PLAYER,
+        'symbol': '▲',
+        'looking_at': None,
+        'color': (0, 255, 100),
+        'inventory': [],
+        'max_inventory_size': 3,
+        'passable_for': []
+    }
+
     def __init__(self, **kwargs):
-        super().__init__()
-        self.name = 'player'
-        self.type = Type.PLAYER
-        self.symbol = '▲'
-        self.looking_at = None
-        self.color = (0, 255, 100)
-        self.inventory = []
-        self.max_inventory_size = 3
-        self.stacked = Empty()
-        self.passable_for = []
-        super().set(**kwargs)
+        super().__init__(**{'stacked': grid.instantiate(Empty), **kwargs})
 
     def push_inventory(self, item):
         """
@@ -166,14 +293,14 @@ class Wall(Object):
     """
     Basic impassable object
     """
-    def __init__(self, **kwargs):
-        super().__init__()
-        self.name = 'wall'
-        self.type = Type.STATIC
-        self.symbol = '#'
-        self.color = (255, 255, 255)
-        self.passable_for = []
-        super().set(**kwargs)
+    flyweight = True
+    fields = {
+        'name': 'wall',
+        'type': Type.STATIC,
+        'symbol': '#',
+        'color': (255, 255, 255),
+        'passable_for': []
+    }
 
 
 class FluxBarrier(Object):
@@ -181,15 +308,14 @@ class FluxBarrier(Object):
     Object which removes given items from all entities
     which pass through it
     """
-    def __init__(self, **kwargs):
-        super().__init__()
-        self.name = "flux_barrier"
-        self.type = Type.DYNAMIC
-        self.symbol = "⍂"
-        self.color = (200, 100, 255)
-        self.passable_for = "all"
-        self.items_removed = []
-        super().set(**kwargs)
+    fields = {
+        'name': "flux_barrier",
+        'type': Type.DYNAMIC,
+        'symbol': "⍂",
+        'color': (200, 100, 255),
+        'passable_for': "all",
+        'items_removed': []
+    }
 
     def on_collision_with(self, collider):
         collider.inventory = [item for item in collider.inventory if item not in self.items_removed]
@@ -200,19 +326,18 @@ class Exit(Object):
     Object which generates another map (level) after
     collision with player
     """
-    def __init__(self, **kwargs):
-        super().__init__()
-        self.name = "exit"
-        self.type = Type.DYNAMIC
-        self.symbol = "⌼"
-        self.color = (100, 100, 255)
-        self.passable_for = ["player"]
-        self.target_level = "level1"
-        super().set(**kwargs)
+    fields = {
+        'name': "exit",
+        'type': Type.DYNAMIC,
+        'symbol': "⌼",
+        'color': (100, 100, 255),
+        'passable_for': ["player"],
+        'target_level': "level1"
+    }
 
     def on_collision_with(self, collider):
         if collider.name == "player":
-            pygame.event.post(pygame.event.Event(Events.LEVEL, {"target": self.target_level}))
+            grid.post(pygame.event.Event(Events.LEVEL, {"target": self.target_level}))
 
 
 class KeyDoor(Object):
@@ -220,19 +345,19 @@ class KeyDoor(Object):
     Object passable for all entities having an item
     with a given name in their inventory
     """
-    def __init__(self, **kwargs):
-        super().__init__()
-        self.name = "key_door"
-        self.type = Type.DYNAMIC
-        self.symbol = "⌻"
-        self.color = (255, 200, 100)
-        self.passable_for = []
-        self.key_name = "small_key"
-        super().set(**kwargs)
+    fields = {
+        'name': "key_door",
+        'type': Type.DYNAMIC,
+        'symbol': "⌻",
+        'color': (255, 200, 100),
+        'passable_for': [],
+        'key_name': "small_key"
+    }
 
     def on_collision_with(self, collider):
+        # passable_for is replaced rather than changed in place, so that the grid is notified
         if collider.name == "player" and collider.has(self.key_name):
-            self.passable_for.append("player")
+            self.passable_for = self.passable_for + ["player"]
         else:
             self.passable_for = []
 
@@ -242,22 +367,25 @@ class ColoredDoor(Object):
     Object passsable for all entities that have an item with given
     name and color in their inventory
     """
-    def __init__(self, **kwargs):
-        super().__init__()
-        self.name = "colored_door"
-        self.type = Type.DYNAMIC
-        self.symbol = "⌻"
-        self.color = (255, 0, 0)
-        self.passable_for = set()
-        self.required_key_name = "small_key"
-        super().set(**kwargs)
+    fields = {
+        'name': "colored_door",
+        'type': Type.DYNAMIC,
+        'symbol': "⌻",
+        'color': (255, 0, 0),
+        'passable_for': set(),
+        'required_key_name': "small_key"
+    }
 
     def on_collision_with(self, collider):
+        # passable_for is replaced rather than changed in place, so that the grid is notified
         for item in collider.inventory:
             if item.name == self.required_key_name and item.color == self.color:
-                self.passable_for.add(collider.name)
+                self.passable_for = self.passable_for | {collider.name}
                 return
-        self.passable_for.discard(collider.name)
+        self.passable_for = self.passable_for - {collider.name}
+
+    def passable_by(self, name, keys=()):
+        return super().passable_by(name, keys) or (self.required_key_name, tuple(self.color)) in keys
 
 
 class ChangingColoredDoor(ColoredDoor):
@@ -265,53 +393,77 @@ class ChangingColoredDoor(ColoredDoor):
     ColoredDoor which change color every tick along
     a given queue
     """
-    def __init__(self, **kwargs):
-        super().__init__()
-        self.color_queue = [Colors.WHITE, Colors.GREEN, Colors.RED]
-        self.color_index = 0
-        super().set(**kwargs)
+    fields = {
+        'color_queue': [Colors.WHITE, Colors.GREEN, Colors.RED],
+        'color_index': 0
+    }
 
     def behavior(self, key):
         self.color_index = (self.color_index + 1) % len(self.color_queue)
         self.color = self.color_queue[self.color_index]
 
 
+class HackableDoor(ColoredDoor):
+    """
+    A colored door whose color can be hacked, so that it opens for another key
+    """
+    fields = {
+        'color': Hackable((255, 0, 0))
+    }
+
+
+class LockedDoor(ColoredDoor):
+    """
+    A colored door whose required key can be hacked
+    """
+    fields = {
+        'required_key_name': Hackable("small_key")
+    }
+
+
 class SmallKey(Object):
     """
     A key used to open doors
     """
-    def __init__(self, **kwargs):
-        super().__init__()
-        self.name = "small_key"
-        self.type = Type.STATIC
-        self.symbol = 'k'
-        self.passable_for = "all"
-        self.color = Colors.WHITE
-        super().set(**kwargs)
+    fields = {
+        'name': "small_key",
+        'type': Type.STATIC,
+        'symbol': 'k',
+        'passable_for': "all",
+        'color': Colors.WHITE
+    }
 
     def on_collision_with(self, collider):
         if collider.name == "player":
             if grid.get_player().push_inventory(self):
-                grid.place_object_f(self.get_coords(), Empty())
+                grid.place_object_f(self.get_coords(), Empty)
+
+
+class HackableKey(SmallKey):
+    """
+    A small key whose color can be hacked
+    """
+    fields = {
+        'color': Hackable(Colors.WHITE)
+    }
 
 
 class BigKey(Object):
     """
     A key used to open doors
     """
-    def __init__(self, **kwargs):
-        super().__init__()
-        self.name = "big_key"
-        self.type = Type.STATIC
-        self.symbol = 'K'
-        self.passable_for = "all"
-        self.color = Colors.WHITE
-        super().set(**kwargs)
+    fields = {
+        'name': "big_key",
+        'type': Type.STATIC,
+        'symbol': 'K',
+        'passable_for': "all",
+        'color': Colors.WHITE
+    }
 
     def on_collision_with(self, collider):
         if collider.name == "player":
             if grid.get_player().push_inventory(self):
-                grid.place_object_f(self.get_coords(), Empty())
+                grid.place_object_f(self.get_coords(), Empty)
 
 
 class AllyDrone(Object):
@@ -320,37 +472,37 @@ class AllyDrone(Object):
     and has an inventory for items. It drops the items upon
     collision with player
     """
+    fields = {
+        'name': "ally_drone",
+        'type': Type.DYNAMIC,
+        'symbol': "⌘",
+        'color': Colors.GREEN,
+        'inventory': [],
+        'passable_for': ["player"]
+    }
+
     def __init__(self, **kwargs):
-        super().__init__()
-        self.name = "ally_drone"
-        self.type = Type.DYNAMIC
-        self.symbol = "⌘"
-        self.color = Colors.GREEN
-        self.stacked = Empty()
-        self.inventory = []
-        self.passable_for = ["player"]
-        super().set(**kwargs)
+        super().__init__(**{'stacked': grid.instantiate(Empty), **kwargs})
 
     def move_towards(self, dest_coords):
         """
-        Moves in the direction, which makes the object travel the most distance
-        towards the target
+        Moves along a shortest path towards the target. If the target can't be reached,
+        moves in the direction, which makes the object travel the most distance towards it.
         :param dest_coords: Target (x, y) coordinates
-        :return:
+        :return: True if movement was successful, False otherwise
         """
         coordinates = self.get_coords()
         delta_x = coordinates[0] - dest_coords[0]
         delta_y = coordinates[1] - dest_coords[1]
         if abs(delta_x) > abs(delta_y):
-            if coordinates[0] > dest_coords[0]:
-                return self.move("left")
-            return self.move("right")
-        if coordinates[1] > dest_coords[1]:
-            return self.move("up")
-        return self.move("down")
+            greedy = "left" if coordinates[0] > dest_coords[0] else "right"
+        else:
+            greedy = "up" if coordinates[1] > dest_coords[1] else "down"
+        direction = pathfinding.direction_towards(grid, self, dest_coords, prefer=greedy)
+        return self.move(direction or greedy)
 
     def behavior(self, key):
-        self.move_towards(grid.match(name="player")[0])
+        self.move_towards(grid.get_player().get_coords())
 
     def on_collision_with(self, collider):
         if collider.name == "player":
@@ -366,23 +518,22 @@ class Computer(Object):
     Object which, after being picked up, enables
     the player to use the console
     """
-    def __init__(self, **kwargs):
-        super().__init__()
-        self.name = "computer"
-        self.type = Type.STATIC
-        self.symbol = "@"
-        self.color = Colors.WHITE
-        self.passable_for = ["player"]
-        super().set(**kwargs)
+    fields = {
+        'name': "computer",
+        'type': Type.STATIC,
+        'symbol': "@",
+        'color': Colors.WHITE,
+        'passable_for': ["player"]
+    }
 
-        # Close the console on spawn, as the player has no computer
-        # pygame.event.post(pygame.event.Event(Events.CONSOLE_TOGGLE, {"on": False}))
+    # Close the console on spawn, as the player has no computer
+    # pygame.event.post(pygame.event.Event(Events.CONSOLE_TOGGLE, {"on": False}))
 
     def on_collision_with(self, collider):
         if collider.name == "player":
             if grid.get_player().push_inventory(self):
                 self.on_pickup()
-                grid.place_object_f(self.get_coords(), Empty())
+                grid.place_object_f(self.get_coords(), Empty)
 
     @staticmethod
     def on_pickup():
@@ -391,24 +542,31 @@ class Computer(Object):
         :return: None
         """
         e = pygame.event.Event(Events.CONSOLE_TOGGLE, on=True)
-        pygame.event.post(e)
+        grid.post(e)
 
 
 class MazeGenerator(Object):
+    fields = {
+        'name': "maze_generator",
+        'type': Type.DYNAMIC,
+        'symbol': "&",
+        'color': Colors.ORANGE,
+        'passable_for': [],
+        'working_area': ((0, 0), (0, 0)),
+        'maze_block_name': "Wall",
+        'path_str': Hackable(((0, 0), "")),
+        'density': 0.9,
+        'path': [],
+        'algorithm': "random",  # "random" or one of maze.ALGORITHMS
+        'seed': None,  # Seed of the maze generator, drawn from the grid random generator by default
+        'generation': 0  # Number of mazes drawn so far
+    }
+
     def __init__(self, **kwargs):
-        super().__init__()
-        self.name = "maze_generator"
-        self.type = Type.DYNAMIC
-        self.symbol = "&"
-        self.color = Colors.ORANGE
-        self.passable_for = []
-        self.working_area = ((0, 0), (0, 0))
-        self.maze_block_name = "Wall"
-        self.path_str = ((0, 0), "")
-        self.density = 0.9
-        self.path = []
-        super().set(**kwargs)
-        self.build_path(*kwargs["path_str"])
+        super().__init__(**kwargs)
+        if self.seed is None:
+            self.seed = grid.rng.getrandbits(32)
+        self.build_path(*self.path_str)
         self.draw_maze()
 
     def build_path(self, start, steps_str):
@@ -426,15 +584,45 @@ class MazeGenerator(Object):
             self.path.append(crd)
 
     def draw_maze(self):
-        for x in range(self.working_area[0][0], self.working_area[1][0]):
-            for y in range(self.working_area[0][1], self.working_area[1][1]):
-                if (x, y) not in self.path and random() < self.density:
-                    grid.place_object_f((x, y), Wall)
-                    continue
-                grid.place_object_f((x, y), Empty)
+        """
+        Fills the working area with a maze, leaving the path empty. The "random" algorithm
+        places walls with a given density, the others (see maze.ALGORITHMS) generate
+        mazes whose cells, on even offsets from the area corner, are all connected.
+        Each maze is generated by a NumPy generator seeded with (seed, generation),
+        so the sequence of mazes only depends on the seed.
+        :return: None
+        """
+        (x1, y1), (x2, y2) = self.working_area
+        shape = (max(x2 - x1, 0), max(y2 - y1, 0))
+        rng = np.random.default_rng([self.seed, self.generation])
+        self.generation += 1
+
+        on_path = np.zeros(shape, dtype=bool)
+        if self.path:
+            xs, ys = np.array(self.path).T - np.array([[x1], [y1]])
+            inside = (xs >= 0) & (xs < shape[0]) & (ys >= 0) & (ys < shape[1])
+            on_path[xs[inside], ys[inside]] = True
+
+        if self.algorithm == "random":
+            walls = maze.random_walls(shape, rng, self.density)
+        else:
+            walls = maze.ALGORITHMS[self.algorithm](shape, rng)
+        grid.paint(self.working_area, walls & ~on_path, Wall, Empty)
+
+    def solvable(self, start, end, name="player"):
+        """
+        Checks if an object can walk between two squares of the working area
+        :param start: (x, y) coordinates of the first square
+        :param end: (x, y) coordinates of the second square
+        :param name: Name of the walking object
+        :return: True if a path exists, False otherwise
+        """
+        (x1, y1), _ = self.working_area
+        walls = ~grid.passable_mask(name, within=self.working_area)
+        return maze.solvable(walls, (start[0] - x1, start[1] - y1), (end[0] - x1, end[1] - y1))
 
     def behavior(self, key):
-        if key == pygame.K_e and grid.find(name='player') in self.get_adjacent().values():
+        if key == pygame.K_e and grid.get_player().get_coords() in self.get_adjacent().values():
             self.build_path(*self.path_str)
             self.draw_maze()
 
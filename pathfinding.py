@@ -0,0 +1,233 @@
+"""
+This file contains the FlowField and DistanceCache classes, which find
+shortest paths of moving objects on the grid
+"""
+
+from collections import OrderedDict, deque
+
+# Direction name -> (dx, dy), in order of preference between equally short paths
+DIRECTIONS = {
+    'right': (1, 0),
+    'left': (-1, 0),
+    'down': (0, 1),
+    'up': (0, -1)
+}
+
+
+def ground(obj):
+    """
+    Returns the object which stays on a square when moving objects leave it.
+    Moving objects (e.g. the player or drones) stand on their stacked object.
+    :param obj: Object on the square
+    :return: The bottom object of the stack
+    """
+    while obj is not None and obj.stacked is not None:
+        obj = obj.stacked
+    return obj
+
+
+def passability_class(obj):
+    """
+    Returns the attributes of a moving object which decide where it can move.
+    Objects of the same class share flow fields.
+    :param obj: The moving object
+    :return: A (name, keys) tuple, keys being a frozenset of (name, color) pairs of carried items
+    """
+    return obj.name, frozenset((item.name, tuple(item.color)) for item in getattr(obj, 'inventory', ()))
+
+
+def enterable(obj, cls):
+    """
+    Checks if objects of a passability class can enter a square, ignoring moving objects on it
+    :param obj: Object on the square
+    :param cls: Passability class of the moving objects, see passability_class()
+    :return: True if the square is passable, False otherwise
+    """
+    obj = ground(obj)
+    return obj is not None and obj.passable_by(*cls)
+
+
+class FlowField:
+    """
+    Distances of the squares of an area to a target square, for objects of a passability class.
+    Computed by a breadth-first search from the target over passable squares of the area,
+    paths leaving the area are not found.
+    """
+    def __init__(self, grid, target, cls, within):
+        """
+        :param grid: The grid
+        :param target: (x, y) coordinates of the target square
+        :param cls: Passability class of the moving objects, see passability_class()
+        :param within: Area of the grid ((x1, y1), (x2, y2)) searched for paths, x2 and y2 excluded
+        """
+        self.grid = grid
+        self.target = tuple(target)
+        self.cls = cls
+        (x1, y1), (x2, y2) = within
+        self.within = (max(x1, 0), max(y1, 0)), (min(x2, grid.width), min(y2, grid.height))
+        (x1, y1), (x2, y2) = self.within
+        self.width, self.height = max(x2 - x1, 0), max(y2 - y1, 0)
+        # Passability of the square (x, y) at index (x - x1) * height + y - y1, read once from the grid
+        # and then kept up to date square by square, see FlowField.update()
+        self.passable = grid.passable_mask(*cls, within=self.within).ravel().tolist()
+        # Distance of the square at the same index, -1 if unreachable
+        self.dist = []
+        # True if the distances must be computed again
+        self.outdated = True
+        # Number of times the distances were computed
+        self.computed = 0
+
+    def index(self, crd):
+        """
+        Returns the index of a square in the lists of the field
+        :param crd: (x, y) coordinates of the square
+        :return: Index, None if the square is outside the area of the field
+        """
+        x, y = crd[0] - self.within[0][0], crd[1] - self.within[0][1]
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return x * self.height + y
+        return None
+
+    def compute(self):
+        """
+        Computes the distances of all squares of the area, if they are outdated
+        :return: None
+        """
+        if not self.outdated:
+            return
+        self.outdated = False
+        self.computed += 1
+        height, passable = self.height, self.passable
+        self.dist = dist = [-1] * len(passable)
+        start = self.index(self.target)
+        if start is None:
+            return
+        dist[start] = 0
+        queue = deque([start])
+        while queue:
+            i = queue.popleft()
+            d = dist[i] + 1
+            x, y = divmod(i, height)
+            # Neighbors in the order of DIRECTIONS, within the area
+            for n, inside in ((i + height, x + 1 < self.width), (i - height, x > 0),
+                              (i + 1, y + 1 < height), (i - 1, y > 0)):
+                if inside and dist[n] < 0 and passable[n]:
+                    dist[n] = d
+                    queue.append(n)
+
+    def update(self, crd):
+        """
+        Reads the passability of a changed square. If it differs from the one the distances
+        were computed with, they are computed again on the next use.
+        :param crd: (x, y) coordinates of the square
+        :return: None
+        """
+        i = self.index(crd)
+        if i is None:
+            return
+        passable = enterable(self.grid.get(crd), self.cls)
+        if self.passable[i] != passable:
+            self.passable[i] = passable
+            self.outdated = True
+
+    def distance(self, crd):
+        """
+        Returns the length of the shortest path from a square to the target
+        :param crd: (x, y) coordinates of the square
+        :return: Number of moves, None if the target can't be reached within the area
+        """
+        i = self.index(crd)
+        if i is None:
+            return None
+        self.compute()
+        d = self.dist[i]
+        return d if d >= 0 else None
+
+    def direction(self, crd, prefer=None):
+        """
+        Returns the direction of the first move of a shortest path from a square to the target
+        :param crd: (x, y) coordinates of the square
+        :param prefer: Direction chosen among equally short paths, if possible
+        :return: Direction "up", "right", "down", "left", None if the target can't be reached
+        """
+        best, best_dist = None, self.distance(crd)
+        if best_dist is None:
+            return None
+        for direction, (dx, dy) in DIRECTIONS.items():
+            d = self.distance((crd[0] + dx, crd[1] + dy))
+            if d is not None and (d < best_dist or d == best_dist and best is not None and direction == prefer):
+                best, best_dist = direction, d
+        return best
+
+
+class DistanceCache:
+    """
+    Least recently used cache of flow fields, keyed by the target square and passability
+    class. A field is shared by all objects of the class chasing the target. It covers the
+    squares within a radius around the target, so objects further away don't find a path.
+    Fields are updated square by square when squares change their passability, the fields
+    of squares a moving target left are evicted when the cache is full.
+    """
+    def __init__(self, grid, size=32, radius=40):
+        """
+        :param grid: The grid
+        :param size: Maximal number of cached fields
+        :param radius: Distance in squares from the target to the border of the area of a field
+        """
+        self.grid = grid
+        self.size = size
+        self.radius = radius
+        self.changes = grid.watch()
+        # ((x, y) target, passability class) -> FlowField, least recently used first
+        self.fields = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, target, cls):
+        """
+        Returns the flow field to a target, creating it if it isn't cached
+        :param target: (x, y) coordinates of the target square
+        :param cls: Passability class of the moving objects, see passability_class()
+        :return: FlowField
+        """
+        self.sync()
+        x, y = target = tuple(target)
+        key = (target, cls)
+        field = self.fields.get(key)
+        if field is not None:
+            self.fields.move_to_end(key)
+            self.hits += 1
+            return field
+        self.misses += 1
+        within = (x - self.radius, y - self.radius), (x + self.radius + 1, y + self.radius + 1)
+        field = self.fields[key] = FlowField(self.grid, target, cls, within)
+        if len(self.fields) > self.size:
+            self.fields.popitem(last=False)
+        return field
+
+    def sync(self):
+        """
+        Updates the fields with the squares changed since the last call
+        :return: None
+        """
+        if not self.changes:
+            return
+        if None in self.changes:
+            self.fields.clear()
+        else:
+            for field in self.fields.values():
+                for crd in self.changes:
+                    field.update(crd)
+        self.changes.clear()
+
+
+def direction_towards(grid, obj, target, prefer=None):
+    """
+    Returns the direction of the first move of a shortest path of an object to a target
+    :param grid: The grid
+    :param obj: The moving object
+    :param target: (x, y) coordinates of the target square
+    :param prefer: Direction chosen among equally short paths, if possible
+    :return: Direction "up", "right", "down", "left", None if the target can't be reached
+    """
+    return grid.distance_map(target, passability_class(obj)).direction(obj.get_coords(), prefer)
@@ -0,0 +1,140 @@
+"""
+This file contains the Profiler class, which instruments the main loop
+"""
+
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from time import perf_counter
+
+
+class Profiler:
+    """
+    Measures time spent in phases of a frame (e.g. event handling, object behaviors,
+    drawing), counts processed objects and issued blits, and keeps a rolling window
+    of frame times for percentiles
+    """
+    def __init__(self, window=300, enabled=True):
+        """
+        :param window: Number of recent frames kept for the frame time percentiles
+        :param enabled: If False, phases and counts are not recorded
+        """
+        self.enabled = enabled
+        self.frame_times = deque(maxlen=window)
+        self.frames = 0
+
+        # Exclusive time in seconds of each phase and counts of the current frame
+        self.phases = {}
+        self.counts = {}
+        # Same for the last finished frame
+        self.last_phases = {}
+        self.last_counts = {}
+        # Exponential moving average of each phase in seconds
+        self.avg_phases = {}
+
+        self._frame_start = None
+        # Time spent in nested phases of each open phase
+        self._stack = []
+
+    def start_frame(self):
+        """
+        Marks the beginning of a frame
+        :return: None
+        """
+        self._frame_start = perf_counter()
+
+    def end_frame(self):
+        """
+        Marks the end of a frame, records its time and resets the phases and counts
+        :return: None
+        """
+        if self._frame_start is None:
+            return
+        self.frame_times.append(perf_counter() - self._frame_start)
+        self._frame_start = None
+        self.frames += 1
+
+        for name in list(self.avg_phases) + [name for name in self.phases if name not in self.avg_phases]:
+            avg = self.avg_phases.get(name, 0)
+            self.avg_phases[name] = avg + (self.phases.get(name, 0) - avg) / min(self.frames, 30)
+        self.last_phases, self.phases = self.phases, {}
+        self.last_counts, self.counts = self.counts, {}
+
+    def phase(self, name):
+        """
+        Returns a context manager, which adds the time spent in the block to a phase.
+        Time of phases nested in the block is not included.
+        :param name: Name of the phase
+        :return: Context manager
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self._phase(name)
+
+    @contextmanager
+    def _phase(self, name):
+        start = perf_counter()
+        self._stack.append(0)
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            nested = self._stack.pop()
+            self.phases[name] = self.phases.get(name, 0) + elapsed - nested
+            if self._stack:
+                self._stack[-1] += elapsed
+
+    def count(self, name, n=1):
+        """
+        Adds to a counter of the current frame
+        :param name: Name of the counter, e.g. "objects" or "blits"
+        :param n: Amount added
+        :return: None
+        """
+        if self.enabled:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def percentile(self, p):
+        """
+        Returns a percentile of recent frame times
+        :param p: Percentile from 0 to 100
+        :return: Frame time in seconds, 0 if no frame was recorded
+        """
+        if not self.frame_times:
+            return 0
+        times = sorted(self.frame_times)
+        return times[min(len(times) - 1, int(p / 100 * len(times)))]
+
+    def report(self):
+        """
+        Returns the collected statistics
+        :return: A dict with the number of frames, frame time percentiles in ms,
+        the last and average time of each phase in ms, and the counts of the last frame
+        """
+        return {
+            'frames': self.frames,
+            'frame_ms': {
+                'p50': round(self.percentile(50) * 1000, 3),
+                'p95': round(self.percentile(95) * 1000, 3),
+                'p99': round(self.percentile(99) * 1000, 3),
+                'max': round(max(self.frame_times, default=0) * 1000, 3)
+            },
+            'phases_ms': {
+                name: {'last': round(self.last_phases.get(name, 0) * 1000, 3), 'avg': round(avg * 1000, 3)}
+                for name, avg in self.avg_phases.items()
+            },
+            'counts': dict(self.last_counts)
+        }
+
+    def lines(self):
+        """
+        Returns the statistics formatted as text
+        :return: A list of strings
+        """
+        report = self.report()
+        frame = report['frame_ms']
+        ret = [f"frames {report['frames']}  p50 {frame['p50']:.2f}  p95 {frame['p95']:.2f}  "
+               f"p99 {frame['p99']:.2f}  max {frame['max']:.2f} ms"]
+        for name, times in report['phases_ms'].items():
+            ret.append(f"{name:8} {times['last']:7.2f} ms  avg {times['avg']:7.2f} ms")
+        ret.append("  ".join(f"{name} {n}" for name, n in report['counts'].items()))
+        return ret
@@ -0,0 +1,140 @@
+"""
+This file contains the Recorder class and functions reading input logs.
+
+A log starts with a header (magic, version, RNG seed, level number),
+followed by entries, each starting with a one byte tag:
+    S - a simulation step: number of events, then (type, key) of each event
+    C - a console command: length, then the UTF-8 encoded command line
+    H - a checkpoint: number of steps recorded so far, then a 16 byte grid state hash
+"""
+
+import struct
+import pygame
+
+MAGIC = b'UTRL'
+VERSION = 2
+HEADER = struct.Struct('<4sBQH')
+STEP = struct.Struct('<cH')
+EVENT = struct.Struct('<Hi')
+COMMAND = struct.Struct('<cH')
+CHECKPOINT = struct.Struct('<cI16s')
+
+# Events which drive the simulation, other events are not recorded
+RECORDED_EVENTS = (pygame.QUIT, pygame.KEYDOWN, pygame.KEYUP)
+
+
+class ReplayError(Exception):
+    """
+    Raised when a log is invalid, or when the replayed state differs from the recorded one
+    """
+
+
+class Recorder:
+    """
+    Writes the input of a game session into a binary log
+    """
+    def __init__(self, path, seed, level, grid, checkpoint_every=50):
+        """
+        :param path: Path of the log file
+        :param seed: Seed of the grid random generator at the start of the session
+        :param level: Number of the level the session starts at
+        :param grid: The grid, hashed at checkpoints
+        :param checkpoint_every: Number of recorded steps between two checkpoints
+        """
+        self.file = open(path, 'wb')
+        self.grid = grid
+        self.checkpoint_every = checkpoint_every
+        self.steps = 0
+        self.file.write(HEADER.pack(MAGIC, VERSION, seed, level))
+
+    def step(self, events, posted=False):
+        """
+        Records a simulation step. Steps without recorded events are skipped,
+        unless they handled events posted by objects.
+        :param events: A list of PyGame events passed to the step
+        :param posted: True if the step handled events posted by objects
+        :return: None
+        """
+        events = [e for e in events if e.type in RECORDED_EVENTS]
+        if not events and not posted:
+            return
+        self.file.write(STEP.pack(b'S', len(events)))
+        for event in events:
+            self.file.write(EVENT.pack(event.type, getattr(event, 'key', 0)))
+        self.steps += 1
+        if self.steps % self.checkpoint_every == 0:
+            self.checkpoint()
+
+    def command(self, line):
+        """
+        Records a console command
+        :param line: Entered command line
+        :return: None
+        """
+        data = line.encode('utf-8')
+        self.file.write(COMMAND.pack(b'C', len(data)) + data)
+
+    def checkpoint(self):
+        """
+        Records the hash of the current grid state
+        :return: None
+        """
+        self.file.write(CHECKPOINT.pack(b'H', self.steps, bytes.fromhex(self.grid.state_hash())))
+        self.file.flush()
+
+    def close(self):
+        """
+        Records a final checkpoint and closes the log
+        :return: None
+        """
+        if self.file.closed:
+            return
+        self.checkpoint()
+        self.file.close()
+
+
+def read_log(path):
+    """
+    Reads an input log
+    :param path: Path of the log file
+    :return: A (seed, level, entries) tuple. Entries are ('step', events),
+    ('command', line) and ('checkpoint', steps, hash) tuples, in order of recording.
+    :raises ReplayError: If the file is not a valid log
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+    try:
+        magic, version, seed, level = HEADER.unpack_from(data)
+    except struct.error:
+        raise ReplayError(f"{path} is not an input log") from None
+    if magic != MAGIC or version != VERSION:
+        raise ReplayError(f"{path} is not an input log of version {VERSION}")
+
+    entries = []
+    offset = HEADER.size
+    try:
+        while offset < len(data):
+            tag = data[offset:offset + 1]
+            if tag == b'S':
+                _, count = STEP.unpack_from(data, offset)
+                offset += STEP.size
+                events = []
+                for _ in range(count):
+                    event_type, key = EVENT.unpack_from(data, offset)
+                    offset += EVENT.size
+                    events.append(pygame.event.Event(event_type, key=key))
+                entries.append(('step', events))
+            elif tag == b'C':
+                _, length = COMMAND.unpack_from(data, offset)
+                offset += COMMAND.size
+                entries.append(('command', data[offset:offset + length].decode('utf-8')))
+                offset += length
+            elif tag == b'H':
+                _, steps, digest = CHECKPOINT.unpack_from(data, offset)
+                offset += CHECKPOINT.size
+                entries.append(('checkpoint', steps, digest.hex()))
+            else:
+                raise ReplayError(f"Unknown entry {tag!r} at byte {offset} of {path}")
+    except struct.error:
+        raise ReplayError(f"{path} is truncated at byte {offset}") from None
+    return seed, level, entries
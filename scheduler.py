@@ -0,0 +1,102 @@
+"""
+This file contains the Scheduler class, which times the main loop
+"""
+
+import pygame
+
+
+class Scheduler:
+    """
+    Times the main loop: waits for events without spinning, runs the simulation
+    in fixed-rate steps and caps the frame rate of rendering
+    """
+    def __init__(self, fps=60, step_rate=30, idle_timeout=1000, max_steps=5):
+        """
+        :param fps: Maximal number of rendered frames per second
+        :param step_rate: Number of simulation steps per second
+        :param idle_timeout: Longest time in ms to block for events while the game is idle
+        :param max_steps: Maximal number of simulation steps run to catch up in one frame
+        """
+        self.fps = fps
+        self.step_ms = 1000 / step_rate
+        self.idle_timeout = idle_timeout
+        self.max_steps = max_steps
+
+        self.clock = pygame.time.Clock()
+        self.frame_start = pygame.time.get_ticks()
+        self.step_lag = 0
+
+        # Frame budget statistics, see Scheduler.report()
+        self.work_ms = 0
+        self.avg_work_ms = 0
+        self.frames = 0
+        self.frames_over_budget = 0
+
+    @property
+    def budget_ms(self):
+        """
+        Time available for one frame
+        :return: Frame budget in ms
+        """
+        return 1000 / self.fps
+
+    def wait(self, idle):
+        """
+        Blocks until an event arrives, or until the next frame is due.
+        :param idle: True if nothing has to be redrawn nor simulated without input,
+        the wait can then last up to idle_timeout
+        :return: A list of PyGame events
+        """
+        if idle:
+            timeout = self.idle_timeout
+        else:
+            timeout = max(0, int(self.budget_ms - (pygame.time.get_ticks() - self.frame_start)))
+
+        first = pygame.event.wait(timeout) if timeout else pygame.event.poll()
+        waited = self.clock.tick()
+        self.frame_start = pygame.time.get_ticks()
+
+        if idle:
+            # Time spent idle is not simulated, input is processed right away
+            self.step_lag = self.step_ms
+        else:
+            self.step_lag += waited
+
+        if first.type == pygame.NOEVENT:
+            return pygame.event.get()
+        return [first] + pygame.event.get()
+
+    def due_steps(self):
+        """
+        Returns the number of simulation steps which should run now
+        :return: Number of steps
+        """
+        steps = min(int(self.step_lag // self.step_ms), self.max_steps)
+        self.step_lag = min(self.step_lag - steps * self.step_ms, self.step_ms)
+        return steps
+
+    def end_frame(self):
+        """
+        Records time spent on the frame since the end of the wait
+        :return: None
+        """
+        self.work_ms = pygame.time.get_ticks() - self.frame_start
+        self.avg_work_ms += (self.work_ms - self.avg_work_ms) / min(self.frames + 1, 30)
+        self.frames += 1
+        if self.work_ms > self.budget_ms:
+            self.frames_over_budget += 1
+
+    def report(self):
+        """
+        Returns the frame budget statistics
+        :return: A dict with the frame budget, work time of the last frame, average
+        work time, budget load and number of frames which exceeded the budget
+        """
+        return {
+            'budget_ms': round(self.budget_ms, 2),
+            'work_ms': self.work_ms,
+            'avg_work_ms': round(self.avg_work_ms, 2),
+            'load': round(self.avg_work_ms / self.budget_ms, 2),
+            'frames': self.frames,
+            'frames_over_budget': self.frames_over_budget
+        }
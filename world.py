@@ -0,0 +1,96 @@
+"""
+This file contains the World class and the batch API, which simulates
+many independent worlds in a process pool
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+import objects
+from grid import create_grid
+from config import GRID_CONFIG
+from init import Game
+
+
+class World:
+    """
+    An independent game instance: a grid with its own objects, id counter and
+    event queue, and a headless Game running on it. Objects of a world may only
+    be used while the world is active, see World.active().
+    """
+    def __init__(self, level=1, seed=None, **grid_config):
+        """
+        :param level: Number of the level loaded into the world
+        :param seed: Seed of the grid random generator, random by default
+        :param grid_config: Grid parameters overriding GRID_CONFIG, see create_grid
+        """
+        self.grid = create_grid(**{**GRID_CONFIG, **grid_config})
+        self.seed = int.from_bytes(os.urandom(8), 'little') if seed is None else seed
+        with self.active():
+            self.game = Game(level, headless=True)
+            self.game.start_level(level, self.seed)
+
+    @contextmanager
+    def active(self):
+        """
+        Makes the world's grid the one manipulated by objects within the block
+        :return: Context manager yielding the world
+        """
+        previous = objects.use_grid(self.grid)
+        try:
+            yield self
+        finally:
+            objects.use_grid(previous)
+
+    def simulate(self, inputs):
+        """
+        Runs the world on a scripted input stream, see Game.simulate()
+        :param inputs: Iterable of key codes or PyGame events
+        :return: Number of steps run
+        """
+        with self.active():
+            return self.game.simulate(inputs)
+
+    def result(self):
+        """
+        Returns a summary of the world state
+        :return: A dict with the current level, the running flag, the player's
+        coordinates (None without a player) and the grid state hash
+        """
+        with self.active():
+            player = self.grid.get_player()
+            return {
+                'level': self.game.level,
+                'running': self.game.running,
+                'player': player.get_coords() if player is not None else None,
+                'state_hash': self.grid.state_hash()
+            }
+
+
+def run_job(job):
+    """
+    Simulates one world
+    :param job: A (level, seed, inputs) tuple, inputs being a sequence of key codes
+    :return: World.result() with the number of steps run
+    """
+    level, seed, inputs = job
+    world = World(level, seed)
+    steps = world.simulate(inputs)
+    return {**world.result(), 'seed': world.seed, 'steps': steps}
+
+
+def simulate_batch(jobs, processes=None, chunksize=1):
+    """
+    Simulates many worlds with many input sequences. Each job runs in a separate
+    world, jobs are distributed over a pool of processes.
+    :param jobs: Iterable of (level, seed, inputs) tuples, inputs being sequences of key codes
+    :param processes: Number of worker processes, all cores by default.
+    With 1 process, the jobs run in the current process.
+    :param chunksize: Number of jobs sent to a worker at once
+    :return: A list of run_job() results, in order of the jobs
+    """
+    if processes == 1:
+        return [run_job(job) for job in jobs]
+    with ProcessPoolExecutor(processes) as pool:
+        return list(pool.map(run_job, jobs, chunksize=chunksize))